@@ -0,0 +1,84 @@
+"""Import time and memory of the client modules, in fresh processes.
+
+Each module is imported in a new Python process, which reports the
+import wall time, its peak RSS and whether TensorFlow got imported. With
+--max-seconds/--max-rss-mb the exit code is 1 when a module exceeds them,
+and any client module importing TensorFlow is always a failure, so the
+script can guard against regressions in CI.
+
+Usage:
+  python -m benchmarks.client_startup
+  python -m benchmarks.client_startup --max-seconds 1.0 --max-rss-mb 150
+"""
+from __future__ import print_function
+
+import sys
+import json
+import argparse
+import subprocess
+
+# Modules a client process imports, none of them may import TensorFlow
+CLIENT_MODULES = [
+    'ml_service.serving_apis',
+    'ml_service.object_detection.ObjectDetection',
+    'ml_service.object_detection.VideoPipeline',
+    'ml_service.object_detection.MicroBatcher',
+    'ml_service.utils.painter',
+    'ml_service.utils.visualizer',
+    'ml_service.utils.parser',
+]
+
+_CHILD = """
+import sys, json, time, resource
+start = time.time()
+__import__(%r)
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed,
+                  'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                  'tensorflow': 'tensorflow.python' in sys.modules}))
+"""
+
+
+def measure(module, repeat):
+  """Best import time and peak RSS of `module` over `repeat` processes"""
+  runs = []
+  for _ in range(repeat):
+    output = subprocess.check_output([sys.executable, '-c', _CHILD % module])
+    runs.append(json.loads(output.decode('utf8').strip().splitlines()[-1]))
+  return {'seconds': min(run['seconds'] for run in runs),
+          'rss_mb': min(run['rss_mb'] for run in runs),
+          'tensorflow': any(run['tensorflow'] for run in runs)}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--modules', nargs='+', default=CLIENT_MODULES)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--max-seconds', type=float, default=None)
+  parser.add_argument('--max-rss-mb', type=float, default=None)
+  parser.add_argument('--baseline', action='store_true',
+                      help='also measure `import tensorflow` for comparison')
+  args = parser.parse_args()
+
+  modules = list(args.modules) + (['tensorflow'] if args.baseline else [])
+  failures = []
+  print('{:<46} {:>9} {:>9} {:>11}'.format('module', 'import s', 'RSS MB', 'tensorflow'))
+  for module in modules:
+    result = measure(module, args.repeat)
+    print('{:<46} {seconds:>9.2f} {rss_mb:>9.0f} {tensorflow!s:>11}'.format(module, **result))
+    if module == 'tensorflow':
+      continue
+    if result['tensorflow']:
+      failures.append('%s imports TensorFlow' % module)
+    if args.max_seconds is not None and result['seconds'] > args.max_seconds:
+      failures.append('%s takes %.2fs to import' % (module, result['seconds']))
+    if args.max_rss_mb is not None and result['rss_mb'] > args.max_rss_mb:
+      failures.append('%s uses %.0f MB' % (module, result['rss_mb']))
+
+  for failure in failures:
+    print('FAIL: ' + failure)
+  sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+  main()
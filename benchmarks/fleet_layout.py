@@ -0,0 +1,74 @@
+"""Compare TF Serving process layouts on this machine.
+
+Runs the deployed model as 1 replica x N threads, N replicas x 1 thread and
+the layouts in between (each replica pinned to its own cores), drives every
+layout with the same closed-loop load spread over the replicas, and reports
+throughput and latency.
+
+Usage:
+  python -m benchmarks.fleet_layout --cores 8 --concurrency 16 --duration 30
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import yaml
+import numpy as np
+
+from ml_service.TFServingFleet import TFServingFleet
+from ml_service.object_detection.ObjectDetection import ObjectDetection
+from ml_service.utils.loadgen import run_load, format_report
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--config', default='config.yml')
+  parser.add_argument('--cores', type=int, default=len(os.sched_getaffinity(0)),
+                      help='number of cores shared by the replicas')
+  parser.add_argument('--layouts', default=None,
+                      help='comma separated replica counts, all divisors of --cores if unset')
+  parser.add_argument('--base-port', type=int, default=9100)
+  parser.add_argument('--concurrency', type=int, default=16)
+  parser.add_argument('--duration', type=float, default=30.0)
+  parser.add_argument('--warmup', type=float, default=5.0)
+  args = parser.parse_args()
+
+  with open(args.config, 'r') as stream:
+    config = yaml.safe_load(stream)
+  inference = config['inference']
+  cpus = sorted(os.sched_getaffinity(0))[:args.cores]
+  if len(cpus) < args.cores:
+    parser.error('only %d cores are available' % len(cpus))
+  if args.layouts:
+    layouts = [int(replicas) for replicas in args.layouts.split(',')]
+  else:
+    layouts = [replicas for replicas in range(1, args.cores + 1) if args.cores % replicas == 0]
+  images = [np.random.randint(0, 255, (inference['frame_height'], inference['frame_width'], 3),
+                              dtype=np.uint8) for _ in range(4)]
+
+  results = []
+  for replicas in layouts:
+    fleet = TFServingFleet.from_config(config, num_replicas=replicas, base_port=args.base_port,
+                                       cpus=cpus, intra_op_parallelism=None, host='localhost')
+    fleet.start()
+    try:
+      if not fleet.wait_until_ready():
+        print('%d replicas: not ready, skipped' % replicas)
+        continue
+      detector = ObjectDetection('localhost', args.base_port, config['model_name'], {},
+                                 max_in_flight=args.concurrency, endpoints=fleet.endpoints)
+      report = run_load(detector.predict, images, concurrency=args.concurrency,
+                        duration=args.duration, warmup=args.warmup)
+    finally:
+      fleet.stop()
+    layout = '%d x %d threads' % (replicas, len(cpus) // replicas)
+    results.append((layout, report))
+    print('{:<18} {}'.format(layout, format_report(report)))
+
+  if results:
+    best = max(results, key=lambda item: item[1]['throughput'])
+    print('\nHighest throughput: %s (%.1f req/s)' % (best[0], best[1]['throughput']))
+
+
+if __name__ == '__main__':
+  main()
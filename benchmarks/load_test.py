@@ -0,0 +1,59 @@
+"""Load test of the ObjectDetection client.
+
+Drives `ObjectDetection` at a given concurrency, request rate and image size
+and reports throughput and p50/p95/p99/max latency. With --fake, an
+in-process FakeTFServingServer answers with canned detections, so no model
+or GPU is needed.
+
+Usage:
+  python -m benchmarks.load_test --fake --latency-ms 30 --concurrency 8
+  python -m benchmarks.load_test --host localhost --port 9000 --rate 20
+"""
+from __future__ import print_function
+
+import argparse
+import numpy as np
+
+from ml_service.FakeTFServingServer import FakeTFServingServer
+from ml_service.object_detection.ObjectDetection import ObjectDetection
+from ml_service.utils.loadgen import run_load, format_report
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--host', default='localhost')
+  parser.add_argument('--port', type=int, default=9000)
+  parser.add_argument('--model', default='faster_rcnn_inception_resnet_v2_atrous_coco')
+  parser.add_argument('--fake', action='store_true', help='serve from an in-process fake server')
+  parser.add_argument('--latency-ms', type=float, default=50.0, help='latency of the fake server')
+  parser.add_argument('--concurrency', type=int, default=1)
+  parser.add_argument('--rate', type=float, default=None, help='requests per second (open loop)')
+  parser.add_argument('--duration', type=float, default=10.0)
+  parser.add_argument('--warmup', type=float, default=1.0)
+  parser.add_argument('--width', type=int, default=640)
+  parser.add_argument('--height', type=int, default=480)
+  parser.add_argument('--batch', type=int, default=1, help='images per request')
+  args = parser.parse_args()
+
+  server = None
+  if args.fake:
+    server = FakeTFServingServer(0, latency_ms=args.latency_ms, max_workers=max(16, args.concurrency))
+    server.start()
+    args.host, args.port = 'localhost', server.port
+
+  detector = ObjectDetection(args.host, args.port, args.model, {}, max_in_flight=args.concurrency)
+  images = [np.random.randint(0, 255, (args.batch, args.height, args.width, 3), dtype=np.uint8)
+            for _ in range(4)]
+
+  print('{} x {}x{}x3 per request, concurrency {}, rate {}'.format(
+      args.batch, args.height, args.width, args.concurrency, args.rate or 'unbounded'))
+  report = run_load(detector.predict_batch, images, concurrency=args.concurrency, rate=args.rate,
+                    duration=args.duration, warmup=args.warmup)
+  print(format_report(report))
+
+  if server is not None:
+    server.stop()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,55 @@
+"""Benchmark of box rendering on video frames.
+
+Compares `painter.draw_boxes`, which draws in place with cv2 and cached
+label bitmaps, against the PIL implementation it replaced.
+
+Usage:
+  python -m benchmarks.painter --width 1920 --height 1080 --boxes 1 10 50 100
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+import numpy as np
+
+from ml_service.utils.painter import draw_boxes, draw_boxes_pil
+
+CLASSES = ['person', 'car', 'bicycle', 'dog', 'traffic light', 'truck']
+
+
+def random_detections(num_boxes, height, width, rng):
+  ymin = rng.uniform(0, 0.8, num_boxes) * height
+  xmin = rng.uniform(0, 0.8, num_boxes) * width
+  boxes = np.stack([ymin, xmin,
+                    ymin + rng.uniform(0.05, 0.2, num_boxes) * height,
+                    xmin + rng.uniform(0.05, 0.2, num_boxes) * width], axis=1)
+  classes = [CLASSES[i] for i in rng.randint(0, len(CLASSES), num_boxes)]
+  return boxes, classes, rng.uniform(0.2, 1.0, num_boxes)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--width', type=int, default=1920)
+  parser.add_argument('--height', type=int, default=1080)
+  parser.add_argument('--boxes', type=int, nargs='+', default=[1, 10, 50, 100])
+  parser.add_argument('--number', type=int, default=20)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  frame = rng.randint(0, 255, (args.height, args.width, 3)).astype(np.uint8)
+
+  print('{}x{} frames, ms per frame'.format(args.width, args.height))
+  print('{:>6} {:>12} {:>12} {:>9}'.format('boxes', 'PIL', 'in place', 'speedup'))
+  for num_boxes in args.boxes:
+    boxes, classes, scores = random_detections(num_boxes, args.height, args.width, rng)
+    draw_boxes(frame, boxes, classes, scores)  # fill the label cache, as on a video
+    timings = []
+    for func in (draw_boxes_pil, draw_boxes):
+      timings.append(min(timeit.repeat(lambda: func(frame, boxes, classes, scores),
+                                       number=args.number, repeat=3)) / args.number)
+    print('{:>6} {:>12.2f} {:>12.2f} {:>8.1f}x'.format(
+        num_boxes, 1000 * timings[0], 1000 * timings[1], timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,59 @@
+"""Microbenchmark of PredictRequest construction and serialization.
+
+Compares the `tf.make_tensor_proto` path against `PredictRequestBuilder`.
+
+Usage:
+  python -m benchmarks.request_serialization --width 640 --height 480 --batch 1
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+import numpy as np
+
+from ml_service.serving_apis import predict_pb2
+from ml_service.object_detection.PredictRequestBuilder import PredictRequestBuilder
+
+
+def make_tensor_proto_request(images, model):
+  import tensorflow as tf
+  request = predict_pb2.PredictRequest()
+  request.inputs['inputs'].CopyFrom(tf.make_tensor_proto(np.stack(images), dtype=tf.uint8))
+  request.model_spec.name = model
+  request.model_spec.signature_name = 'predict_images'
+  return request
+
+
+def report(name, func, number):
+  best = min(timeit.repeat(func, number=number, repeat=5)) / number
+  print('{:<32} {:>10.3f} ms'.format(name, 1000 * best))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--width', type=int, default=640)
+  parser.add_argument('--height', type=int, default=480)
+  parser.add_argument('--batch', type=int, default=1)
+  parser.add_argument('--number', type=int, default=100)
+  args = parser.parse_args()
+
+  model = 'faster_rcnn_inception_resnet_v2_atrous_coco'
+  images = [np.random.randint(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+            for _ in range(args.batch)]
+  builder = PredictRequestBuilder(model)
+
+  print('Batch of {} x {}x{}x3 uint8'.format(args.batch, args.height, args.width))
+  report('PredictRequestBuilder.build', lambda: builder.build(images), args.number)
+  report('  + SerializeToString', lambda: builder.build(images).SerializeToString(), args.number)
+  try:
+    import tensorflow  # pylint: disable=unused-variable
+  except ImportError:
+    print('TensorFlow is not installed, skipping tf.make_tensor_proto baseline')
+    return
+  report('tf.make_tensor_proto', lambda: make_tensor_proto_request(images, model), args.number)
+  report('  + SerializeToString',
+         lambda: make_tensor_proto_request(images, model).SerializeToString(), args.number)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,66 @@
+"""Benchmark of `visualize_boxes_and_labels_on_image_array`.
+
+Compares the per-box rendering, which converts the full frame for every
+box, mask and keypoint set, against the single-pass rendering.
+
+Usage:
+  python -m benchmarks.visualizer --width 1920 --height 1080 --detections 10 50 100
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+import numpy as np
+
+from ml_service.utils.visualizer import visualize_boxes_and_labels_on_image_array
+
+
+def random_detections(num_detections, height, width, num_keypoints, rng):
+  ymin = rng.uniform(0, 0.8, num_detections)
+  xmin = rng.uniform(0, 0.8, num_detections)
+  boxes = np.stack([ymin, xmin,
+                    ymin + rng.uniform(0.05, 0.2, num_detections),
+                    xmin + rng.uniform(0.05, 0.2, num_detections)], axis=1)
+  masks = np.zeros((num_detections, height, width), dtype=np.float32)
+  for mask, (y1, x1, y2, x2) in zip(masks, boxes * [height, width, height, width]):
+    mask[int(y1):int(y2), int(x1):int(x2)] = 1.0
+  keypoints = rng.uniform(0, 1, (num_detections, num_keypoints, 2))
+  classes = rng.randint(1, 4, num_detections)
+  scores = rng.uniform(0.6, 1.0, num_detections)
+  return boxes, classes, scores, masks, keypoints
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--width', type=int, default=1920)
+  parser.add_argument('--height', type=int, default=1080)
+  parser.add_argument('--detections', type=int, nargs='+', default=[10, 50, 100])
+  parser.add_argument('--keypoints', type=int, default=4)
+  parser.add_argument('--number', type=int, default=3)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  frame = rng.randint(0, 255, (args.height, args.width, 3)).astype(np.uint8)
+  category_index = {1: {'id': 1, 'name': 'person'}, 2: {'id': 2, 'name': 'car'},
+                    3: {'id': 3, 'name': 'dog'}}
+
+  print('{}x{} frames with masks and {} keypoints, ms per frame'.format(
+      args.width, args.height, args.keypoints))
+  print('{:>10} {:>12} {:>12} {:>9}'.format('detections', 'per box', 'single pass', 'speedup'))
+  for num_detections in args.detections:
+    boxes, classes, scores, masks, keypoints = random_detections(
+        num_detections, args.height, args.width, args.keypoints, rng)
+    timings = []
+    for single_pass in (False, True):
+      def render():
+        visualize_boxes_and_labels_on_image_array(
+            frame.copy(), boxes, classes, scores, category_index,
+            instance_masks=masks, keypoints=keypoints, use_normalized_coordinates=True,
+            max_boxes_to_draw=None, single_pass=single_pass)
+      timings.append(min(timeit.repeat(render, number=args.number, repeat=3)) / args.number)
+    print('{:>10} {:>12.1f} {:>12.1f} {:>8.1f}x'.format(
+        num_detections, 1000 * timings[0], 1000 * timings[1], timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+  main()
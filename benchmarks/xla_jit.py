@@ -0,0 +1,52 @@
+"""CPU latency of an exported SavedModel with and without the XLA JIT.
+
+Loads the same export twice in a local `tf.Session`, once as exported
+(grappler rewrites only) and once with XLA auto-clustering, in a process
+started with the `TF_XLA_FLAGS` of TF Serving. It reports
+load time, first inference time (the warmup cost, XLA compilation
+included) and the latency of the following inferences.
+
+Usage:
+  python -m benchmarks.xla_jit --export-path /home/dat/model_zoo/faster_rcnn_inception_resnet_v2_atrous_coco/1
+  python -m benchmarks.xla_jit --export-path ... --images ./samples --runs 50
+"""
+from __future__ import print_function
+
+import argparse
+import numpy as np
+
+from ml_service.utils.converter import benchmark_saved_model
+from ml_service.utils.converter import benchmark_saved_model_xla
+from ml_service.utils.converter import format_variant_report
+from ml_service.utils.converter import load_sample_images
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--export-path', required=True, help='directory of a SavedModel version')
+  parser.add_argument('--signature', default='predict_images')
+  parser.add_argument('--images', default=None, help='directory of sample images, random if unset')
+  parser.add_argument('--width', type=int, default=640)
+  parser.add_argument('--height', type=int, default=480)
+  parser.add_argument('--runs', type=int, default=20)
+  args = parser.parse_args()
+
+  if args.images:
+    images = load_sample_images(args.images, (args.width, args.height), limit=args.runs)
+  else:
+    images = [np.random.randint(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+              for _ in range(4)]
+
+  reports = [('graph rewriter', benchmark_saved_model(args.export_path, images, args.signature,
+                                                      runs=args.runs)),
+             ('xla jit', benchmark_saved_model_xla(args.export_path, images, args.signature,
+                                                   runs=args.runs))]
+  print(format_variant_report(reports))
+
+  baseline, jit = reports[0][1], reports[1][1]
+  print('\nXLA JIT: {} XLA ops, p50 speedup x{:.2f}, warmup cost {:+.0f} ms'.format(
+      jit['xla_ops'], baseline['p50'] / jit['p50'], jit['first_run_ms'] - baseline['first_run_ms']))
+
+
+if __name__ == '__main__':
+  main()
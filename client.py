@@ -4,22 +4,23 @@ import yaml
 import numpy as np
 
 from ml_service.utils.painter import draw_boxes
-from ml_service.utils.parser import parse_label_map
+from ml_service.utils.parser import parse_label_map, read_endpoints
 
 from ml_service.object_detection.ObjectDetection import ObjectDetection
+from ml_service.object_detection.Preprocessor import Preprocessor
+from ml_service.object_detection.TiledDetection import TiledDetection
 
 def main():
   # ############
   # Parse Config
   # ############
   with open('config.yml', 'r') as stream:
-    config = yaml.load(stream)
+    config = yaml.safe_load(stream)
   model_name = config['model_name']
   inference = config['inference']
   label_dict = parse_label_map(config['label_map'])
   
   img = cv2.imread('camera0.jpg')
-  h, w, _ = img.shape
 
   # Initialize Object Detection Client
   object_detector = ObjectDetection(
@@ -27,17 +28,32 @@ def main():
       inference['port'],
       model_name, 
       label_dict, 
-      verbose=True)
+      verbose=True,
+      endpoints=read_endpoints(inference.get('endpoints')))
 
   print('Detecting objects...')
-  bboxes, classes, scores = object_detector.predict(img, img_dtype=np.uint8, timeout=60)
-
-  filtered_outputs = [(box, idx, score) for box, idx, score in zip(bboxes, classes, scores)
-                      if score > inference['score_threshold']]
-  if zip(*filtered_outputs):
-    boxes, classes, scores = zip(*filtered_outputs)
-    boxes = [box * np.array([h, w, h, w]) for box in boxes]
-    img = draw_boxes(img, boxes, classes, scores)
+  tiling = inference.get('tiling')
+  if tiling:
+    # Native resolution, boxes are returned in pixels
+    tiled_detector = TiledDetection(
+        object_detector,
+        tile_size=(tiling['tile_width'], tiling['tile_height']),
+        overlap=tiling.get('overlap', 0.2),
+        iou_threshold=config['deploy_params']['iou_threshold'],
+        score_threshold=inference['score_threshold'])
+    boxes, classes, scores = tiled_detector.predict(img, img_dtype=np.uint8, timeout=60)
+    if len(boxes):
+      img = draw_boxes(img, boxes, classes, scores)
+  else:
+    # Frames are sent at the model input size, not at their native resolution
+    preprocessor = Preprocessor((inference['frame_width'], inference['frame_height']))
+    batch, transforms = preprocessor.process([img])
+    bboxes, classes, scores = object_detector.predict(batch[0], img_dtype=np.uint8, timeout=60)
+
+    keep = scores > inference['score_threshold']
+    if np.any(keep):
+      boxes = preprocessor.restore_boxes([bboxes[keep]], transforms)[0]
+      img = draw_boxes(img, boxes, classes[keep], scores[keep])
 
   cv2.imwrite('output.jpg', img)
   print('Done!')
@@ -1,13 +1,36 @@
 """Deploy any trained TF model for inference.
 
-This script optimizes a trained model by quantizing the weights and converts trained model
-to servable TF Serving Model.
+This script optimizes a trained model with Graph Transform Tool presets and converts
+the trained model to servable TF Serving Models. Several variants can be exported in one
+run and compared on SavedModel size, load time and CPU inference latency.
+
+Variants with `quantize_nodes` are calibrated on sample images when
+--calibration-images is set, and the report then compares their detections
+with the first float variant.
+
+Usage:
+  python deploy.py                                   # `deploy_params` of config.yml
+  python deploy.py --variants default optimized quantized --images ./samples
+  python deploy.py --variants optimized quantized --calibration-images ./calibration --images ./samples
 """
 from __future__ import print_function
 
 import os
+import json
+import argparse
+import yaml
+import numpy as np
 import tensorflow as tf
 from ml_service.utils.converter import load_graph_from_pb
+from ml_service.utils.converter import write_warmup_requests
+from ml_service.utils.converter import load_sample_images
+from ml_service.utils.converter import benchmark_saved_model
+from ml_service.utils.converter import format_variant_report
+from ml_service.utils.converter import benchmark_saved_model_xla
+from ml_service.utils.converter import calibrate_quantized_graph
+from ml_service.utils.converter import detection_agreement
+from ml_service.utils.converter import TRANSFORM_PRESETS
+from ml_service.TFServingServer import DEFAULT_BATCHING_PARAMETERS
 
 # TF Libraries to export model into .pb file
 from tensorflow.python.client import session
@@ -15,61 +38,172 @@ from tensorflow.python.saved_model import signature_constants
 from tensorflow.core.protobuf import rewriter_config_pb2
 from tensorflow.tools.graph_transforms import TransformGraph
 
+# ######################
+#  Interference Pipeline
+# ######################
+INPUT_NAMES = 'image_tensor'
+ENCODED_INPUT_NAMES = 'encoded_image_string_tensor'
+OUTPUT_NAMES = ['detection_boxes', 'detection_classes', 'detection_scores', 'num_detections']
 
-def _main_():
-    # #################
-    # Setup export path
-    ###################
-    # @TODO: create Argument Parse
-    base_dir   = './ml_service/object_detection'
-    model_filename = './ml_service/object_detection/faster_rcnn_inception_resnet_v2_atrous_coco/frozen_inference_graph.pb'
-
-    version    = 1
-    model_name = 'faster_rcnn_inception_resnet_v2_atrous_coco'
-    output_dir = os.path.join(base_dir, model_name)
-    export_path = os.path.join(output_dir, str(version))
-
-    # ######################
-    #  Interference Pipeline
-    # ######################
-    input_names = 'image_tensor'
-    output_names = ['detection_boxes', 'detection_classes', 'detection_scores', 'num_detections']
-
-    with tf.Session() as sess:
-      input_tensor = tf.placeholder(dtype=tf.uint8, shape=(None, None, None, 3), name=input_names)
-
-      # ###################
-      # load frozen graph
-      # ###################
-      graph_def = load_graph_from_pb(model_filename)
-      outputs = tf.import_graph_def(
-          graph_def,
-          input_map={'image_tensor': input_tensor},
-          return_elements=output_names,
-          name='')
-      outputs = [sess.graph.get_tensor_by_name(ops.name + ':0')for ops in outputs]
-      outputs = dict(zip(output_names, outputs))
-
-    # #####################
-    # Quantize Frozen Model
-    # #####################
-    transforms = ["add_default_attributes",
-                  "quantize_weights", "round_weights",
-                  "fold_batch_norms", "fold_old_batch_norms"]
-
-    quantized_graph = TransformGraph(
+
+def _decode_image(encoded_image):
+    """Decode one JPEG/PNG string into a uint8 [height, width, 3] image.
+    All images of a batch must have the same size."""
+    image = tf.image.decode_image(encoded_image, channels=3)
+    image.set_shape([None, None, 3])
+    return image
+
+
+def postprocess_detections(outputs, score_threshold=0.0, iou_threshold=0.5,
+                           max_detections=100, nms='per_class'):
+    """Filter the raw detections inside the serving graph, so only the kept
+    detections are sent to the clients.
+
+    Args:
+      outputs: a dictionary of the `OUTPUT_NAMES` tensors of the detection graph
+      score_threshold: detections with a lower score are dropped
+      iou_threshold: overlap above which the box with the lower score is suppressed
+      max_detections: maximum number of detections per image
+      nms: 'per_class' (boxes of different classes never suppress each other),
+        'class_agnostic' or 'none'
+
+    Returns:
+      a dictionary of the same tensors. Images of a batch are padded to the
+      largest number of kept detections, `num_detections` counts them.
+    """
+    if nms not in ('per_class', 'class_agnostic', 'none'):
+        raise ValueError("Unknown NMS mode '%s'" % nms)
+
+    def _filter(args):
+        boxes, classes, scores, num_detections = args
+        valid = tf.logical_and(tf.range(tf.shape(scores)[0]) < tf.cast(num_detections, tf.int32),
+                               scores >= score_threshold)
+        boxes = tf.boolean_mask(boxes, valid)
+        classes = tf.boolean_mask(classes, valid)
+        scores = tf.boolean_mask(scores, valid)
+
+        if nms == 'none':
+            # Raw detections are sorted by score
+            keep = tf.range(tf.minimum(tf.shape(scores)[0], max_detections))
+        else:
+            nms_boxes = boxes
+            if nms == 'per_class':
+                # Shift every class to its own region: boxes are normalized to [0, 1]
+                nms_boxes = boxes + 2.0 * tf.expand_dims(classes, 1)
+            keep = tf.image.non_max_suppression(nms_boxes, scores, max_detections, iou_threshold)
+
+        num_kept = tf.size(keep)
+        padding = max_detections - num_kept
+        return (tf.pad(tf.gather(boxes, keep), [[0, padding], [0, 0]]),
+                tf.pad(tf.gather(classes, keep), [[0, padding]]),
+                tf.pad(tf.gather(scores, keep), [[0, padding]]),
+                tf.cast(num_kept, tf.float32))
+
+    boxes, classes, scores, num_detections = tf.map_fn(
+        _filter,
+        [outputs[name] for name in OUTPUT_NAMES],
+        dtype=(tf.float32, tf.float32, tf.float32, tf.float32),
+        back_prop=False)
+
+    # Trim the padding shared by all the images of the batch
+    max_kept = tf.cast(tf.reduce_max(tf.concat([num_detections, [0.0]], 0)), tf.int32)
+    return {'detection_boxes': tf.identity(boxes[:, :max_kept], name='postprocessed_boxes'),
+            'detection_classes': tf.identity(classes[:, :max_kept], name='postprocessed_classes'),
+            'detection_scores': tf.identity(scores[:, :max_kept], name='postprocessed_scores'),
+            'num_detections': tf.identity(num_detections, name='postprocessed_num_detections')}
+
+
+def parse_args(deploy_params):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='config.yml',
+                        help='configuration file, its `deploy_params` are the defaults')
+    parser.add_argument('--frozen-graph', default=deploy_params.get('frozen_graph'),
+                        help='frozen inference graph (.pb) of the trained model')
+    parser.add_argument('--output-path', default=deploy_params.get('output_path'),
+                        help='directory of the exported models')
+    parser.add_argument('--version', type=int, default=deploy_params.get('version', 1))
+    parser.add_argument('--variants', nargs='+', default=deploy_params.get('variants', ['default']),
+                        help='transform presets to export: %s. With several variants, each one '
+                             'is exported as `<model_name>_<variant>`' % ', '.join(sorted(TRANSFORM_PRESETS)))
+    parser.add_argument('--images', default=deploy_params.get('sample_images'),
+                        help='directory of sample images for the report, random frames if unset')
+    parser.add_argument('--calibration-images', default=deploy_params.get('calibration_images'),
+                        help='directory of images measuring the activation ranges of the eight-bit variants')
+    parser.add_argument('--calibration-steps', type=int, default=deploy_params.get('calibration_steps', 100),
+                        help='maximum number of calibration images')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='number of timed inferences per variant')
+    parser.add_argument('--xla', action='store_true', default=deploy_params.get('xla', False),
+                        help='also report every variant compiled with the XLA JIT')
+    parser.add_argument('--no-report', action='store_true',
+                        help='skip the size/load time/latency report')
+    return parser
+
+
+def optimize_graph(graph_def, transforms):
+    """Apply Graph Transform Tool `transforms` to a frozen graph"""
+    return TransformGraph(
         input_graph_def=graph_def,
-        inputs=input_names,
-        outputs=output_names,
+        inputs=[INPUT_NAMES],
+        outputs=OUTPUT_NAMES,
         transforms=transforms)
 
-    # #####################
-    # Export to TF Serving#
-    # #####################
+
+def warmup_batch_sizes(config, batch_sizes):
+    """Cap the warmup batch sizes at the `max_batch_size` of `serving.batching`.
+
+    With batching enabled, TF Serving rejects larger requests and a failed
+    warmup request stops the model from loading. The same holds for the
+    servers of `server.py --autotune`, a warning is printed when its grid
+    goes below the warmup batch sizes.
+    """
+    serving = config.get('serving', {})
+    if not serving.get('enable_batching'):
+        return list(batch_sizes)
+    max_batch_size = dict(DEFAULT_BATCHING_PARAMETERS, **serving.get('batching', {}))['max_batch_size']
+    capped = sorted(set(min(batch_size, max_batch_size) for batch_size in batch_sizes))
+    if max(batch_sizes) > max_batch_size:
+        print("Warmup batch sizes {} capped to {} by serving.batching.max_batch_size".format(
+            list(batch_sizes), capped))
+
+    autotune_sizes = serving.get('autotune', {}).get('max_batch_size', [])
+    if autotune_sizes and min(autotune_sizes) < max(capped):
+        print("Warning: autotuned servers with max_batch_size < {} will fail to load this model, "
+              "lower deploy_params.warmup_batch_sizes to autotune them".format(max(capped)))
+    return capped
+
+
+def _is_quantized(transforms):
+    return any(transform.startswith('quantize_nodes') for transform in transforms)
+
+
+def export_saved_model(graph_def, export_path, postprocess=None):
+    """Export a frozen detection graph as a TF Serving SavedModel with
+    the `predict_images` and `predict_encoded_images` signatures
+
+    Args:
+      graph_def: a frozen detection graph
+      export_path: directory of the SavedModel version
+      postprocess: keyword arguments of `postprocess_detections`,
+        raw detections are returned if None
+    """
     # Reference: https://github.com/tensorflow/models/tree/master/research/object_detection
 
     with tf.Graph().as_default():
-        tf.import_graph_def(quantized_graph, name='')
+        # Encoded images (JPEG/PNG bytes) are decoded inside the graph. When
+        # `image_tensor` is fed directly, the decoding ops are not executed.
+        encoded_tensor = tf.placeholder(dtype=tf.string, shape=(None,), name=ENCODED_INPUT_NAMES)
+        decoded_tensor = tf.map_fn(_decode_image, encoded_tensor, dtype=tf.uint8, back_prop=False)
+        input_tensor = tf.placeholder_with_default(decoded_tensor, shape=(None, None, None, 3), name=INPUT_NAMES)
+
+        outputs = tf.import_graph_def(
+            graph_def,
+            input_map={INPUT_NAMES + ':0': input_tensor},
+            return_elements=[name + ':0' for name in OUTPUT_NAMES],
+            name='')
+        outputs = dict(zip(OUTPUT_NAMES, outputs))
+        if postprocess is not None:
+            outputs = postprocess_detections(outputs, **postprocess)
 
         # Optimizing graph
         rewrite_options = rewriter_config_pb2.RewriterConfig(layout_optimizer=True)
@@ -81,13 +215,13 @@ def _main_():
         # Build model for TF Serving
         config = tf.ConfigProto(graph_options=graph_options)
 
-        # @TODO: add XLA for higher performance (AOT for ARM, JIT for x86/GPUs)
-        # https://www.tensorflow.org/performance/xla/
-        # config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        # The session config is not saved in the SavedModel: the XLA JIT is
+        # enabled at serving time (`serving.xla`, see `TFServingServer`)
 
         with session.Session(config=config) as sess:
             builder = tf.saved_model.builder.SavedModelBuilder(export_path)
             tensor_info_inputs = {'inputs': tf.saved_model.utils.build_tensor_info(input_tensor)}
+            tensor_info_encoded_inputs = {'inputs': tf.saved_model.utils.build_tensor_info(encoded_tensor)}
             tensor_info_outputs = {}
             for k, v in outputs.items():
                 tensor_info_outputs[k] = tf.saved_model.utils.build_tensor_info(v)
@@ -97,16 +231,121 @@ def _main_():
                             inputs=tensor_info_inputs,
                             outputs=tensor_info_outputs,
                             method_name=signature_constants.PREDICT_METHOD_NAME))
+            encoded_detection_signature = (
+                    tf.saved_model.signature_def_utils.build_signature_def(
+                            inputs=tensor_info_encoded_inputs,
+                            outputs=tensor_info_outputs,
+                            method_name=signature_constants.PREDICT_METHOD_NAME))
 
             builder.add_meta_graph_and_variables(
                     sess, [tf.saved_model.tag_constants.SERVING],
                     signature_def_map={'predict_images': detection_signature,
+                                       'predict_encoded_images': encoded_detection_signature,
                                        signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: detection_signature,
                                        },
             )
             builder.save()
 
-    print("\n\nModel is ready for TF Serving. (saved at {}/saved_model.pb)".format(export_path))
+
+def _main_():
+    # #################
+    # Parse config and arguments
+    ###################
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument('--config', default='config.yml')
+    config_file = config_parser.parse_known_args()[0].config
+    with open(config_file, 'r') as stream:
+        config = yaml.safe_load(stream)
+    model_name = config['model_name']
+    inference = config['inference']
+    deploy_params = config['deploy_params']
+    args = parse_args(deploy_params).parse_args()
+
+    presets = dict(TRANSFORM_PRESETS, **deploy_params.get('transform_presets', {}))
+    unknown = [variant for variant in args.variants if variant not in presets]
+    if unknown:
+        raise ValueError('Unknown transform presets %s, choose from %s' % (unknown, sorted(presets)))
+    if not args.frozen_graph:
+        raise ValueError('No frozen graph, set `deploy_params.frozen_graph` or --frozen-graph')
+
+    postprocess = None
+    if deploy_params.get('nms', 'per_class') != 'none' or deploy_params.get('score_threshold', 0.0) > 0:
+        postprocess = dict(score_threshold=deploy_params.get('score_threshold', 0.0),
+                           iou_threshold=deploy_params.get('iou_threshold', 0.5),
+                           max_detections=deploy_params.get('max_detections', 100),
+                           nms=deploy_params.get('nms', 'per_class'))
+
+    frame_size = (inference['frame_width'], inference['frame_height'])
+    if args.images:
+        images = load_sample_images(args.images, frame_size, limit=args.runs)
+    else:
+        images = [np.random.randint(0, 255, (frame_size[1], frame_size[0], 3), dtype=np.uint8)
+                  for _ in range(4)]
+
+    calibration_images = None
+    if args.calibration_images:
+        calibration_images = load_sample_images(args.calibration_images, frame_size,
+                                                limit=args.calibration_steps)
+
+    # ###################
+    # load frozen graph
+    # ###################
+    graph_def = load_graph_from_pb(args.frozen_graph)
+
+    reports = []
+    detections = {}
+    for variant in args.variants:
+        # Only one variant: it is the served model, otherwise pick one from the report
+        name = model_name if len(args.variants) == 1 else '{}_{}'.format(model_name, variant)
+        export_path = os.path.join(args.output_path, name, str(args.version))
+
+        # ##########################
+        # Optimize and export variant
+        # ##########################
+        print("Exporting '{}' with transforms {}".format(variant, presets[variant]))
+        if calibration_images and _is_quantized(presets[variant]):
+            print("Calibrating eight-bit ranges on {} images".format(len(calibration_images)))
+            variant_graph = calibrate_quantized_graph(graph_def, presets[variant], calibration_images,
+                                                      [INPUT_NAMES], OUTPUT_NAMES)
+        else:
+            variant_graph = optimize_graph(graph_def, presets[variant])
+        export_saved_model(variant_graph, export_path, postprocess)
+
+        # Requests replayed by TF Serving when it loads the model
+        write_warmup_requests(
+            export_path, name,
+            image_sizes=deploy_params.get('warmup_image_sizes',
+                                          [(inference['frame_height'], inference['frame_width'])]),
+            batch_sizes=warmup_batch_sizes(config, deploy_params.get('warmup_batch_sizes', [1])))
+        print("Model is ready for TF Serving. (saved at {}/saved_model.pb)".format(export_path))
+
+        if not args.no_report:
+            detections[variant] = []
+            report = benchmark_saved_model(export_path, images, runs=args.runs,
+                                           detections=detections[variant])
+            report.update(variant=variant, export_path=export_path, transforms=presets[variant])
+            reports.append((variant, report))
+            if args.xla:
+                detections[variant + '+xla'] = []
+                report = benchmark_saved_model_xla(export_path, images, runs=args.runs,
+                                                   detections=detections[variant + '+xla'])
+                report.update(variant=variant + '+xla', export_path=export_path,
+                              transforms=presets[variant])
+                reports.append((variant + '+xla', report))
+
+    # Detections of the eight-bit variants against the first float variant
+    float_variants = [name for name, report in reports if not _is_quantized(report['transforms'])]
+    if float_variants and len(reports) > 1:
+        for name, report in reports:
+            report['agreement'] = detection_agreement(detections[float_variants[0]], detections[name])
+            report['agreement_with'] = float_variants[0]
+
+    if reports:
+        report_path = os.path.join(args.output_path, '{}_variants.json'.format(model_name))
+        with open(report_path, 'w') as f:
+            json.dump([report for _, report in reports], f, indent=2)
+        print("\n" + format_variant_report(reports))
+        print("\nReport saved at {}".format(report_path))
 
 
 if __name__ == '__main__':
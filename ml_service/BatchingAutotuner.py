@@ -0,0 +1,125 @@
+"""Autotune TF Serving batching parameters under a synthetic load
+"""
+from __future__ import print_function
+
+import itertools
+import numpy as np
+
+from ml_service.TFServingServer import TFServingServer
+from ml_service.TFServingServer import DEFAULT_BATCHING_PARAMETERS
+from ml_service.TFServingServer import write_batching_parameters
+from ml_service.object_detection.ObjectDetection import ObjectDetection
+from ml_service.utils.loadgen import run_load, format_report
+
+# Parameters swept when config.yml does not say otherwise
+DEFAULT_GRID = {
+    'max_batch_size': [1, 4, 8, 16],
+    'batch_timeout_micros': [0, 2000, 5000, 10000],
+    'num_batch_threads': [2, 4, 8],
+}
+
+
+class BatchingAutotuner(object):
+  """Sweep `max_batch_size`, `batch_timeout_micros` and `num_batch_threads`.
+
+  Every combination starts a TF Serving server with those parameters, runs
+  a synthetic closed-loop load against it and records throughput and
+  latency. The best combination is the one with the highest throughput
+  whose p99 latency stays within `latency_slo_ms` and whose share of
+  failed requests stays within `max_error_rate`. A combination whose
+  server does not start is recorded as failed and the sweep goes on.
+  """
+
+  def __init__(self, server_factory, grid=None, latency_slo_ms=200.0, concurrency=16,
+               duration=10.0, warmup=2.0, frame_size=(640, 480), ready_timeout=120.0,
+               max_error_rate=0.0):
+    """
+    Args:
+      server_factory: a callable taking batching parameters and returning
+        a server (`TFServingServer` or `FakeTFServingServer`) with `port`,
+        `model_name`, `start` and `stop`
+      grid: a dictionary - key: batching parameter, value: list of values
+      latency_slo_ms: maximum p99 latency of an acceptable configuration
+      concurrency: number of concurrent single-image requests
+      duration: number of seconds each combination is measured
+      warmup: number of seconds of requests sent before measuring
+      frame_size: (width, height) of the synthetic images
+      ready_timeout: number of seconds to wait for a server to load the model
+      max_error_rate: maximum fraction of failed requests of an acceptable
+        configuration
+    """
+    self.server_factory = server_factory
+    self.grid = dict(DEFAULT_GRID, **(grid or {}))
+    self.latency_slo_ms = latency_slo_ms
+    self.concurrency = concurrency
+    self.duration = duration
+    self.warmup = warmup
+    self.ready_timeout = ready_timeout
+    self.max_error_rate = max_error_rate
+    width, height = frame_size
+    self.images = [np.random.randint(0, 255, (height, width, 3), dtype=np.uint8)
+                   for _ in range(4)]
+    self.results = []
+
+  @classmethod
+  def from_config(cls, config):
+    """Create an autotuner for the server described in `config.yml`"""
+    autotune = dict(config.get('serving', {}).get('autotune', {}))
+    inference = config['inference']
+
+    def server_factory(batching_parameters):
+      return TFServingServer.from_config(config, batching_parameters=batching_parameters)
+
+    grid = dict((key, autotune.pop(key)) for key in list(autotune) if key in DEFAULT_GRID)
+    return cls(server_factory, grid=grid,
+               frame_size=(inference['frame_width'], inference['frame_height']),
+               **autotune)
+
+  def run(self):
+    """Measure every combination of the grid.
+
+    Returns:
+      the best batching parameters, or None if none meets the latency SLO
+      and the error rate
+    """
+    keys = sorted(self.grid)
+    for values in itertools.product(*[self.grid[key] for key in keys]):
+      batching_parameters = dict(DEFAULT_BATCHING_PARAMETERS, **dict(zip(keys, values)))
+      print("Trying %s" % dict(zip(keys, values)))
+      try:
+        report = self._measure(batching_parameters)
+      except (RuntimeError, IOError, OSError) as e:
+        report = {'requests': 0, 'errors': 0, 'throughput': 0.0, 'failure': str(e)}
+        print("  failed: %s" % e)
+      else:
+        print("  " + format_report(report))
+      self.results.append((batching_parameters, report))
+    return self.best()
+
+  def best(self):
+    candidates = [(params, report) for params, report in self.results
+                  if report['requests'] and report['p99'] <= self.latency_slo_ms and
+                  report['errors'] <= self.max_error_rate * (report['requests'] + report['errors'])]
+    if not candidates:
+      return None
+    return max(candidates, key=lambda item: item[1]['throughput'])[0]
+
+  def write_best(self, path):
+    """Write the best batching parameters to `path`. Returns them."""
+    best = self.best()
+    if best is not None:
+      write_batching_parameters(path, best)
+    return best
+
+  def _measure(self, batching_parameters):
+    server = self.server_factory(batching_parameters)
+    server.start()
+    try:
+      if not server.wait_until_ready(self.ready_timeout):
+        raise RuntimeError('Serving Server on port %d is not ready' % server.port)
+      detector = ObjectDetection('localhost', server.port, server.model_name, {},
+                                 max_in_flight=self.concurrency)
+      return run_load(detector.predict, self.images, concurrency=self.concurrency,
+                      duration=self.duration, warmup=self.warmup)
+    finally:
+      server.stop()
@@ -0,0 +1,95 @@
+"""In-process stand-in for a Tensorflow Serving Object Detection Server
+"""
+from __future__ import print_function
+
+import time
+from concurrent import futures
+
+import grpc
+import numpy as np
+from ml_service.serving_apis import predict_pb2
+from ml_service.serving_apis import prediction_service_pb2_grpc
+
+
+class FakePredictionService(prediction_service_pb2_grpc.PredictionServiceServicer):
+  """Answer every Predict call with canned detection tensors after a
+  configurable latency, the way TF Serving answers for the exported model"""
+
+  def __init__(self, latency_ms=50.0, per_image_ms=0.0, num_detections=20, max_detections=100,
+               num_classes=90, seed=0):
+    self.latency = latency_ms / 1000.0
+    self.per_image = per_image_ms / 1000.0
+    self.num_detections = min(num_detections, max_detections)
+
+    rng = np.random.RandomState(seed)
+    ymin, xmin = rng.uniform(0.0, 0.8, (2, max_detections))
+    height, width = rng.uniform(0.05, 0.2, (2, max_detections))
+    self.boxes = np.stack([ymin, xmin, ymin + height, xmin + width], axis=1).astype(np.float32)
+    self.classes = rng.randint(1, num_classes + 1, max_detections).astype(np.float32)
+    self.scores = np.sort(rng.uniform(0.0, 1.0, max_detections)).astype(np.float32)[::-1]
+    self.scores[self.num_detections:] = 0.0
+
+  def Predict(self, request, context):
+    batch_size = request.inputs['inputs'].tensor_shape.dim[0].size
+    time.sleep(self.latency + self.per_image * batch_size)
+
+    response = predict_pb2.PredictResponse()
+    response.model_spec.CopyFrom(request.model_spec)
+    _set_float_output(response, 'detection_boxes', np.tile(self.boxes, (batch_size, 1, 1)))
+    _set_float_output(response, 'detection_classes', np.tile(self.classes, (batch_size, 1)))
+    _set_float_output(response, 'detection_scores', np.tile(self.scores, (batch_size, 1)))
+    _set_float_output(response, 'num_detections',
+                      np.full(batch_size, self.num_detections, dtype=np.float32))
+    return response
+
+
+def _set_float_output(response, name, array):
+  # TF Serving sends outputs in the typed `float_val` field
+  tensor = response.outputs[name]
+  tensor.dtype = 1  # DT_FLOAT
+  for size in array.shape:
+    tensor.tensor_shape.dim.add().size = size
+  tensor.float_val.extend(array.ravel().tolist())
+
+
+class FakeTFServingServer(object):
+  """Same interface as `TFServingServer`, but serves canned detections
+  from a gRPC server in this process. No model or GPU is needed.
+  """
+  def __init__(self, port, latency_ms=50.0, max_workers=16, model_name='fake_model', **kwargs):
+    """
+    Args:
+      port: an int - port to create detection server (0 picks a free port)
+      latency_ms: time each Predict call takes
+      max_workers: number of requests handled at once
+      model_name: name of the served model, any name is answered
+      kwargs: extra arguments of `FakePredictionService`
+    """
+    self.port = port
+    self.model_name = model_name
+    self.server = None
+    self.running = False
+    self.max_workers = max_workers
+    self.service = FakePredictionService(latency_ms=latency_ms, **kwargs)
+
+  def is_running(self):
+    return self.running
+
+  def is_ready(self):
+    return self.running
+
+  def wait_until_ready(self, timeout=300.0):
+    return self.running
+
+  def start(self):
+    if not self.running:
+      self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.max_workers))
+      prediction_service_pb2_grpc.add_PredictionServiceServicer_to_server(self.service, self.server)
+      self.port = self.server.add_insecure_port('[::]:%d' % self.port)
+      self.server.start()
+      self.running = True
+
+  def stop(self, grace=None):
+    if self.running:
+      self.server.stop(grace)
+      self.running = False
@@ -0,0 +1,169 @@
+"""Event-driven supervisor of TF Serving server processes
+"""
+from __future__ import print_function
+
+import os
+import time
+import errno
+import fcntl
+import select
+import signal
+
+
+class ServerSupervisor(object):
+  """Keep one or more `TFServingServer` processes up until asked to stop.
+
+  The supervisor sleeps until a signal arrives: SIGCHLD when a server
+  process exits, SIGINT/SIGTERM when it should shut down. A crashed server
+  is restarted after an exponential backoff (`base_backoff` * 2^(crashes - 1),
+  capped by `max_backoff`). The crash count is reset once a server has been
+  up for `stable_after` seconds. On shutdown, every server drains its
+  in-flight requests before it is terminated.
+
+  Signals wake the supervisor through `signal.set_wakeup_fd` and a
+  self-pipe watched with `select`: the handlers only set flags, they never
+  take a lock the interrupted main thread may be holding.
+
+  Signal handlers can only be installed from the main thread.
+  """
+
+  def __init__(self, servers, base_backoff=1.0, max_backoff=60.0, stable_after=60.0,
+               ready_timeout=300.0, grace=30.0):
+    """
+    Args:
+      servers: a `TFServingServer` or a list of them
+      base_backoff: seconds before the first restart of a crashed server
+      max_backoff: maximum number of seconds before a restart
+      stable_after: seconds a server must stay up to reset its crash count
+      ready_timeout: seconds to wait for a server to load its model
+      grace: seconds each server has to drain on shutdown
+    """
+    self.servers = servers if isinstance(servers, (list, tuple)) else [servers]
+    self.base_backoff = base_backoff
+    self.max_backoff = max_backoff
+    self.stable_after = stable_after
+    self.ready_timeout = ready_timeout
+    self.grace = grace
+
+    self._wakeup_fds = None
+    self._shutdown = False
+    self._crashes = dict((id(server), 0) for server in self.servers)
+    self._started_at = {}
+    self._restart_at = {}
+
+  def run(self):
+    """Start the servers and supervise them until SIGINT/SIGTERM."""
+    read_fd, write_fd = os.pipe()
+    for fd in (read_fd, write_fd):
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self._wakeup_fds = read_fd, write_fd
+    previous_fd = signal.set_wakeup_fd(write_fd)
+    previous = dict((signum, signal.signal(signum, self._on_signal))
+                    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGCHLD))
+    try:
+      for server in self.servers:
+        self._start(server)
+      self._wait_until_ready()
+
+      while not self._shutdown:
+        self._sleep(self._next_timeout())
+        if self._shutdown:
+          break
+        self._check_servers()
+    finally:
+      print("\nWaiting for last predictions before turning off...")
+      for server in self.servers:
+        server.stop(self.grace)
+      for signum, handler in previous.items():
+        signal.signal(signum, handler)
+      signal.set_wakeup_fd(previous_fd)
+      self._wakeup_fds = None
+      os.close(read_fd)
+      os.close(write_fd)
+
+  def shutdown(self):
+    """Ask `run` to stop the servers and return."""
+    self._shutdown = True
+    self._wakeup()
+
+  def _on_signal(self, signum, frame):
+    # Runs between two bytecodes of the main thread: set flags only, the
+    # wakeup fd has already been written by the C-level handler
+    if signum in (signal.SIGINT, signal.SIGTERM):
+      self._shutdown = True
+
+  def _wakeup(self):
+    fds = self._wakeup_fds
+    if fds is None:
+      return
+    try:
+      os.write(fds[1], b'\0')
+    except OSError as e:
+      if e.errno not in (errno.EAGAIN, errno.EBADF):  # pipe full: already awake
+        raise
+
+  def _sleep(self, timeout):
+    """Block until a signal or `shutdown` writes to the wakeup pipe, or
+    `timeout` seconds (forever if None) have passed."""
+    read_fd = self._wakeup_fds[0]
+    try:
+      select.select([read_fd], [], [], timeout)
+    except (select.error, OSError) as e:  # EINTR on Python 2
+      if e.args[0] != errno.EINTR:
+        raise
+    # Drain the pipe, one pass of `_check_servers` handles all the signals
+    try:
+      while os.read(read_fd, 4096):
+        pass
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def _start(self, server):
+    server.start()
+    self._started_at[id(server)] = time.time()
+    self._restart_at.pop(id(server), None)
+
+  def _wait_until_ready(self):
+    """Poll the model status of the started servers until they serve."""
+    deadline = time.time() + self.ready_timeout
+    pending = list(self.servers)
+    while pending and not self._shutdown:
+      for server in list(pending):
+        if server.is_ready():
+          print("Model '%s' is ready on port %d" % (server.model_name, server.port))
+          pending.remove(server)
+        elif not server.is_running():
+          pending.remove(server)  # crashed, restarted by the main loop
+      if time.time() > deadline:
+        for server in pending:
+          print("Model '%s' on port %d is not ready after %ds" %
+                (server.model_name, server.port, self.ready_timeout))
+        return
+      if pending:
+        time.sleep(0.5)
+
+  def _check_servers(self):
+    now = time.time()
+    for server in self.servers:
+      key = id(server)
+      if server.is_running():
+        continue
+
+      if key not in self._restart_at:
+        # Newly crashed: schedule a restart
+        if now - self._started_at[key] >= self.stable_after:
+          self._crashes[key] = 0
+        self._crashes[key] += 1
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** (self._crashes[key] - 1))
+        print("Serving Server on port %d exited with code %s, restarting in %.1fs" %
+              (server.port, server.server.returncode, backoff))
+        self._restart_at[key] = now + backoff
+      elif now >= self._restart_at[key]:
+        self._start(server)
+
+  def _next_timeout(self):
+    """Sleep until the next scheduled restart, or until a signal arrives."""
+    if not self._restart_at:
+      return None
+    return max(0.0, min(self._restart_at.values()) - time.time())
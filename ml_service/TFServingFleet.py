@@ -0,0 +1,103 @@
+"""Fleet of core-pinned Tensorflow Serving replicas
+"""
+import os
+import socket
+
+import numpy as np
+
+from ml_service.TFServingServer import TFServingServer
+from ml_service.TFServingServer import DEFAULT_BATCHING_PARAMETERS
+
+
+class TFServingFleet(object):
+  """Manage N TF Serving replicas of the same model on one machine.
+
+  On many-core CPU hosts, several small servers often scale better than one
+  big one. Each replica listens on its own port (`base_port` + i), is
+  pinned to its own slice of the CPU cores and gets matching intra-op and
+  inter-op thread counts. The fleet is supervised like a single server
+  with `ServerSupervisor(fleet.servers)`.
+  """
+
+  def __init__(self, num_replicas, base_port, model_name, model_path, cpus=None,
+               intra_op_parallelism=None, inter_op_parallelism=1, host=None, **kwargs):
+    """
+    Args:
+      num_replicas: number of server processes
+      base_port: port of the first replica, the others use the next ports
+      model_name: name of detection model
+      model_path: path to the directory containing the model versions
+      cpus: list of CPU cores shared between the replicas,
+        all cores available to this process if None
+      intra_op_parallelism: threads per op of each replica,
+        the number of cores of the replica if None
+      inter_op_parallelism: number of ops each replica runs in parallel
+      host: host name published in the endpoints, this machine if None
+      kwargs: extra arguments of `TFServingServer`
+    """
+    if cpus is None:
+      cpus = sorted(os.sched_getaffinity(0))
+    if num_replicas > len(cpus):
+      raise ValueError('Cannot pin %d replicas to %d cores' % (num_replicas, len(cpus)))
+    self.host = host or socket.gethostname()
+    self.servers = []
+    for i, cores in enumerate(np.array_split(np.asarray(cpus), num_replicas)):
+      cores = [int(core) for core in cores]
+      self.servers.append(TFServingServer(
+          port=base_port + i,
+          model_name=model_name,
+          model_path=model_path,
+          cpu_affinity=cores,
+          intra_op_parallelism=intra_op_parallelism or len(cores),
+          inter_op_parallelism=inter_op_parallelism,
+          **kwargs))
+
+  @classmethod
+  def from_config(cls, config, **kwargs):
+    """Create a fleet from the `serving` and `serving.fleet` sections of `config.yml`"""
+    serving = config.get('serving', {})
+    fleet = serving.get('fleet', {})
+    batching_parameters = None
+    if serving.get('enable_batching'):
+      batching_parameters = dict(DEFAULT_BATCHING_PARAMETERS, **serving.get('batching', {}))
+    params = dict(
+        num_replicas=fleet.get('replicas', 1),
+        base_port=serving.get('port', config['inference']['port']),
+        model_name=config['model_name'],
+        model_path=config['model_path'],
+        cpus=fleet.get('cpus'),
+        intra_op_parallelism=fleet.get('intra_op_parallelism'),
+        inter_op_parallelism=fleet.get('inter_op_parallelism', 1),
+        batching_parameters=batching_parameters,
+        config_dir=serving.get('config_dir', './serving_config'),
+        xla=serving.get('xla', False))
+    params.update(kwargs)
+    return cls(**params)
+
+  @property
+  def endpoints(self):
+    """'host:port' of every replica"""
+    return ['%s:%d' % (self.host, server.port) for server in self.servers]
+
+  def publish_endpoints(self, path):
+    """Write the endpoints, one per line, for clients to spread load
+    across the replicas (see `parser.read_endpoints`)"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write('\n'.join(self.endpoints) + '\n')
+    os.rename(tmp_path, path)
+    return path
+
+  def start(self):
+    for server in self.servers:
+      server.start()
+
+  def wait_until_ready(self, timeout=300.0):
+    return all([server.wait_until_ready(timeout) for server in self.servers])
+
+  def stop(self, grace=30.0):
+    for server in self.servers:
+      server.stop(grace)
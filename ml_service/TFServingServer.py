@@ -1,64 +1,244 @@
 """Tensorflow Serving Object Detection Server
 """
 import os
-import signal
+import shlex
 import time
 import subprocess
 
+import grpc
+from ml_service.serving_apis import get_model_status_pb2
+from ml_service.serving_apis import model_management_pb2
+from ml_service.serving_apis import model_service_pb2_grpc
+
+_AVAILABLE = get_model_status_pb2.ModelVersionStatus.AVAILABLE
+_END = get_model_status_pb2.ModelVersionStatus.END
+
 UNIX_COMMAND = \
-"tensorflow_model_server --port={} --model_name={} --model_base_path={} --per_process_gpu_memory_fraction={}"
+"tensorflow_model_server --port={} --model_config_file={} --per_process_gpu_memory_fraction={}"
+
+BATCHING_FLAGS = " --enable_batching --batching_parameters_file={}"
+
+THREADING_FLAGS = " --tensorflow_intra_op_parallelism={} --tensorflow_inter_op_parallelism={}"
+
+# XLA auto-clustering of the served graphs, CPU included
+XLA_JIT_FLAGS = "--tf_xla_auto_jit=2 --tf_xla_cpu_global_jit"
+
+# Defaults of TF Serving `BatchingParameters`
+DEFAULT_BATCHING_PARAMETERS = {
+    'max_batch_size': 8,
+    'batch_timeout_micros': 5000,
+    'num_batch_threads': 4,
+    'max_enqueued_batches': 100,
+}
+
+
+def write_batching_parameters(path, batching_parameters):
+  """Write a `BatchingParameters` text proto for --batching_parameters_file
+
+  Args:
+    path: output file
+    batching_parameters: a dictionary, e.g. {'max_batch_size': 8, ...}
+  """
+  with open(path, 'w') as f:
+    for key, value in sorted(batching_parameters.items()):
+      f.write("%s { value: %d }\n" % (key, value))
+  return path
+
+
+def write_model_config(path, model_name, model_path):
+  """Write a `ModelServerConfig` text proto for --model_config_file
+
+  Args:
+    path: output file
+    model_name: name of detection model
+    model_path: path to the directory containing the model versions
+  """
+  with open(path, 'w') as f:
+    f.write("model_config_list {\n"
+            "  config {\n"
+            "    name: '%s'\n"
+            "    base_path: '%s'\n"
+            "    model_platform: 'tensorflow'\n"
+            "  }\n"
+            "}\n" % (model_name, os.path.abspath(model_path)))
+  return path
+
 
 class TFServingServer(object):
   """Manage TF Serving Server for inference.
   This object will manage turning on/off server
   """
-  def __init__(self, port, model_name, model_path, per_process_gpu_memory_fraction=0.0):
+  def __init__(self, port, model_name, model_path, per_process_gpu_memory_fraction=0.0,
+               batching_parameters=None, config_dir='./serving_config',
+               cpu_affinity=None, intra_op_parallelism=0, inter_op_parallelism=0, xla=False):
     """
     Args:
       model_name: name of detection model -
         should match with the directory model
       model_path: path to the directory containing frozen model
       port: an int - port to create detection server
+      batching_parameters: a dictionary of TF Serving batching parameters
+        (see `DEFAULT_BATCHING_PARAMETERS`). Batching is disabled if None
+      config_dir: directory where the model config and batching parameters
+        files are generated
+      cpu_affinity: set of CPU cores the server process may run on,
+        all cores if None
+      intra_op_parallelism: number of threads of a single op (0 lets
+        TensorFlow decide)
+      inter_op_parallelism: number of ops run in parallel (0 lets
+        TensorFlow decide)
+      xla: compile the served graphs with the XLA JIT, the server must be
+        built with XLA support
     """
     self.port = port
     self.server = None
-    self.running = False
-    
+    self._channel = None
+
     self.model_path = model_path
     self.model_name = model_name
     self.gpu_mem = per_process_gpu_memory_fraction
+    self.batching_parameters = batching_parameters
+    self.config_dir = config_dir
+    self.cpu_affinity = set(cpu_affinity) if cpu_affinity else None
+    self.intra_op_parallelism = intra_op_parallelism
+    self.inter_op_parallelism = inter_op_parallelism
+    self.xla = xla
+
+  @classmethod
+  def from_config(cls, config, **kwargs):
+    """Create a server from the parsed `config.yml`"""
+    serving = config.get('serving', {})
+    batching_parameters = None
+    if serving.get('enable_batching'):
+      batching_parameters = dict(DEFAULT_BATCHING_PARAMETERS, **serving.get('batching', {}))
+    params = dict(
+        port=serving.get('port', config['inference']['port']),
+        model_name=config['model_name'],
+        model_path=config['model_path'],
+        per_process_gpu_memory_fraction=serving.get('per_process_gpu_memory_fraction', 0.0),
+        batching_parameters=batching_parameters,
+        config_dir=serving.get('config_dir', './serving_config'),
+        xla=serving.get('xla', False))
+    params.update(kwargs)
+    return cls(**params)
 
   def is_running(self):
-    return self.running
+    """True while the server process is alive"""
+    return self.server is not None and self.server.poll() is None
+
+  def model_states(self, timeout=5.0):
+    """Ask the server for the state of every version of the model.
+
+    Returns:
+      a list of `ModelVersionStatus.State`, empty if the server cannot be reached
+    """
+    request = get_model_status_pb2.GetModelStatusRequest()
+    request.model_spec.name = self.model_name
+    try:
+      response = self._model_service().GetModelStatus(request, timeout)
+    except grpc.RpcError:
+      return []
+    return [status.state for status in response.model_version_status]
+
+  def is_ready(self):
+    """True once a version of the model is loaded and can serve requests"""
+    return self.is_running() and _AVAILABLE in self.model_states()
+
+  def wait_until_ready(self, timeout=300.0, interval=0.5):
+    """Block until the model is available.
+
+    Returns:
+      True if the model is ready, False if the server died or timed out
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      if not self.is_running():
+        return False
+      if self.is_ready():
+        return True
+      time.sleep(interval)
+    return False
+
+  def write_config_files(self):
+    """Generate the files passed to tensorflow_model_server
+
+    Returns:
+      the command line launching the server
+    """
+    if not os.path.isdir(self.config_dir):
+      os.makedirs(self.config_dir)
+    prefix = os.path.join(self.config_dir, '%s_%d' % (self.model_name, self.port))
+    command = UNIX_COMMAND.format(
+        self.port,
+        write_model_config(prefix + '.model_config', self.model_name, self.model_path),
+        self.gpu_mem)
+    if self.batching_parameters:
+      command += BATCHING_FLAGS.format(
+          write_batching_parameters(prefix + '.batching_parameters', self.batching_parameters))
+    if self.intra_op_parallelism or self.inter_op_parallelism:
+      command += THREADING_FLAGS.format(self.intra_op_parallelism, self.inter_op_parallelism)
+    return command
 
   def start(self):
-    if not self.running:
+    if not self.is_running():
       print("Serving Server is launching ... ")
-      self.server = subprocess.Popen(UNIX_COMMAND.format(
-          self.port,
-          self.model_name,
-          self.model_path,
-          self.gpu_mem),
-          stdin=subprocess.PIPE, shell=True)
+      env = None
+      if self.xla:
+        env = dict(os.environ, TF_XLA_FLAGS=XLA_JIT_FLAGS)
+      self.server = subprocess.Popen(
+          shlex.split(self.write_config_files()),
+          stdin=subprocess.PIPE, preexec_fn=self._prepare_process, env=env)
+      self._channel = None
       print("Serving Server is started at PID %s\n" % self.server.pid)
-      self.running = True
     else:
       print("Serving Server has been activated already..\n")
 
-  def stop(self):
-    if self.running:
-      self.running = True
-      self._turn_off_server()
+  def _prepare_process(self):
+    """Run in the child process before tensorflow_model_server starts"""
+    # Own session, so a Ctrl-C in the terminal reaches the supervisor
+    # only, which then shuts the server down
+    os.setsid()
+    if self.cpu_affinity:
+      os.sched_setaffinity(0, self.cpu_affinity)
+
+  def wait(self, timeout=None):
+    """Block until the server process exits. Returns its exit code."""
+    return self.server.wait(timeout)
+
+  def stop(self, grace=30.0):
+    """Drain in-flight requests then terminate the server.
+
+    The model is unloaded first: TF Serving only unloads a version once
+    the requests using it are done. Then the process gets SIGTERM, and
+    SIGKILL if it is still alive after `grace` seconds.
+    """
+    if self.is_running():
+      deadline = time.time() + grace
+      self._drain(deadline)
+      self.server.terminate()
+      try:
+        self.server.wait(max(deadline - time.time(), 1.0))
+      except subprocess.TimeoutExpired:
+        self.server.kill()
+        self.server.wait()
       print("Serving Server is off now\n")
     else:
       print("Serving Server is not activated yet..\n")
 
-  def _turn_off_server(self):
-    ps_command = subprocess.Popen(
-        "kill -9 $(lsof -t -i:%d -sTCP:LISTEN)" % self.port,
-        shell=True,
-        stdout=subprocess.PIPE)
-    ps_output = ps_command.stdout.read()
-    for pid_str in ps_output.split("\n")[:-1]:
-      os.kill(int(pid_str), signal.SIGINT)
-    self.server.terminate()
+  def _drain(self, deadline):
+    request = model_management_pb2.ReloadConfigRequest()
+    request.config.model_config_list.SetInParent()  # serve no model
+    try:
+      self._model_service().HandleReloadConfigRequest(request, max(deadline - time.time(), 1.0))
+    except grpc.RpcError:
+      return
+    while time.time() < deadline and self.is_running():
+      states = self.model_states()
+      if not states or all(state == _END for state in states):
+        return
+      time.sleep(0.2)
+
+  def _model_service(self):
+    if self._channel is None:
+      self._channel = grpc.insecure_channel('localhost:%d' % self.port)
+    return model_service_pb2_grpc.ModelServiceStub(self._channel)
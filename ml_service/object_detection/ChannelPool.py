@@ -0,0 +1,101 @@
+"""Pool of gRPC channels to several TF Serving replicas"""
+from __future__ import absolute_import
+
+import time
+import threading
+
+import grpc
+from ml_service.serving_apis import prediction_service_pb2_grpc
+
+# Errors that mean the replica itself is unhealthy (not the request)
+_REPLICA_FAILURES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+
+
+class Replica(object):
+  """One TF Serving endpoint and its book-keeping"""
+
+  def __init__(self, endpoint):
+    self.endpoint = endpoint
+    self.channel = grpc.insecure_channel(endpoint)
+    self.stub = prediction_service_pb2_grpc.PredictionServiceStub(self.channel)
+    self.in_flight = 0
+    self.failures = 0
+    self.ejected_until = 0.0
+
+  def __repr__(self):
+    return 'Replica(%s, in_flight=%d, failures=%d)' % (self.endpoint, self.in_flight, self.failures)
+
+
+class ChannelPool(object):
+  """Route requests to the replica with the fewest in-flight requests.
+
+  A replica that fails with UNAVAILABLE or DEADLINE_EXCEEDED is ejected
+  for an exponential backoff (`base_backoff` * 2^(failures - 1), capped by
+  `max_backoff`), then tried again. If every replica is ejected, the one
+  that comes back first is used rather than failing the request locally.
+
+  A request failing with UNAVAILABLE never reached the server, the client
+  retries it once on another replica, see `acquire(exclude=...)`.
+  """
+
+  def __init__(self, endpoints, base_backoff=1.0, max_backoff=30.0):
+    """
+    Args:
+      endpoints: a list of 'host:port' strings
+      base_backoff: seconds a replica is ejected after its first failure
+      max_backoff: maximum number of seconds a replica is ejected
+    """
+    if not endpoints:
+      raise ValueError('At least one endpoint is required')
+    self.replicas = [Replica(endpoint) for endpoint in endpoints]
+    self.base_backoff = base_backoff
+    self.max_backoff = max_backoff
+    self._lock = threading.Lock()
+    self._next = 0
+
+  @property
+  def endpoints(self):
+    return [replica.endpoint for replica in self.replicas]
+
+  def acquire(self, exclude=None):
+    """Pick a replica for a new request. Must be paired with `release`.
+
+    Args:
+      exclude: a replica not to pick, e.g. the one a request just failed
+        on. None is returned if no other replica is healthy
+    """
+    now = time.time()
+    with self._lock:
+      healthy = [r for r in self.replicas if r.ejected_until <= now and r is not exclude]
+      if not healthy and exclude is not None:
+        return None
+      if healthy:
+        # Rotate the starting point so ties are broken round-robin
+        self._next = (self._next + 1) % len(healthy)
+        healthy = healthy[self._next:] + healthy[:self._next]
+        replica = min(healthy, key=lambda r: r.in_flight)
+      else:
+        replica = min(self.replicas, key=lambda r: r.ejected_until)
+      replica.in_flight += 1
+    return replica
+
+  def release(self, replica, error=None):
+    """Return a replica to the pool once its request is done.
+
+    Args:
+      replica: the replica returned by `acquire`
+      error: the exception raised by the request, if any
+    """
+    with self._lock:
+      replica.in_flight -= 1
+      if error is None:
+        replica.failures = 0
+        replica.ejected_until = 0.0
+      elif isinstance(error, grpc.RpcError) and error.code() in _REPLICA_FAILURES:
+        replica.failures += 1
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** (replica.failures - 1))
+        replica.ejected_until = time.time() + backoff
+
+  def close(self):
+    for replica in self.replicas:
+      replica.channel.close()
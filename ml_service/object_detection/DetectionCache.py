@@ -0,0 +1,221 @@
+"""Content-addressed cache of detection results"""
+from __future__ import absolute_import
+
+import os
+import tempfile
+import threading
+import collections
+import numpy as np
+
+from ml_service.utils.hash_utils import new_hash
+
+# The disk tier is pruned down to this fraction of its limits
+_DISK_LOW_WATERMARK = 0.9
+
+
+class DetectionCache(object):
+  """LRU cache of (boxes, classes, scores) keyed by the image content.
+
+  Byte-identical frames (fixed cameras, retried uploads) are only sent to
+  the server once. Entries are evicted in least-recently-used order when
+  either `max_entries` or `max_bytes` is exceeded.
+
+  If `disk_dir` is set, results are also written there as `.npz` files, so
+  worker processes on the same host can reuse each other's results. Every
+  `max_disk_entries` / 10 writes, the least recently used files are removed
+  until the directory is back under 90% of `max_disk_entries` and
+  `max_disk_bytes`.
+
+  Keys include an explicit model version: results of a "latest" version
+  would still be served after a new version is deployed.
+  """
+
+  def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, disk_dir=None,
+               max_disk_entries=100000, max_disk_bytes=1024 * 1024 * 1024):
+    """
+    Args:
+      max_entries: maximum number of results kept in memory
+      max_bytes: maximum total size of the results kept in memory
+      disk_dir: optional directory of a shared on-disk tier
+      max_disk_entries: maximum number of files of the disk tier
+      max_disk_bytes: maximum total size of the files of the disk tier
+    """
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.disk_dir = disk_dir
+    self.max_disk_entries = max_disk_entries
+    self.max_disk_bytes = max_disk_bytes
+
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.disk_evictions = 0
+    self.nbytes = 0
+
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._disk_writes = 0
+    self._prune_interval = max(self.max_disk_entries // 10, 1)
+    if self.disk_dir:
+      if not os.path.isdir(self.disk_dir):
+        os.makedirs(self.disk_dir)
+      self._prune_disk()
+
+  @staticmethod
+  def key(image, model, version, resolve_labels=True):
+    """Hash of an image buffer (numpy array or encoded bytes) plus
+    the model name, version and label format
+
+    Args:
+      image: the image sent to the server
+      model: name of the served model
+      version: version of the served model, required
+      resolve_labels: whether the classes are names or int ids, see
+        `ObjectDetection`
+    """
+    if version is None:
+      raise ValueError('Detection results are cached per model version, got None')
+    digest = new_hash()
+    if isinstance(image, np.ndarray):
+      image = np.ascontiguousarray(image)
+      digest.update(('%s%s' % (image.shape, image.dtype)).encode('utf-8'))
+      image = memoryview(image).cast('B')
+    digest.update(image)
+    digest.update(('%s:%s:%d' % (model, version, bool(resolve_labels))).encode('utf-8'))
+    return digest.hexdigest()
+
+  def get(self, key):
+    """
+    Returns:
+      a writable copy of the cached (boxes, classes, scores) tuple, or None
+    """
+    with self._lock:
+      prediction = self._entries.get(key)
+      if prediction is not None:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return _copy(prediction)
+
+    prediction = self._read_disk(key)
+    with self._lock:
+      if prediction is None:
+        self.misses += 1
+        return None
+      self.disk_hits += 1
+    self._insert(key, prediction)
+    return _copy(prediction)
+
+  def put(self, key, prediction):
+    """Cache a read-only copy of a (boxes, classes, scores) tuple, the
+    caller's arrays are left as they are."""
+    prediction = _copy(prediction)
+    for array in prediction:
+      array.flags.writeable = False
+    self._insert(key, prediction)
+    self._write_disk(key, prediction)
+
+  @property
+  def stats(self):
+    with self._lock:
+      return {'entries': len(self._entries), 'bytes': self.nbytes,
+              'hits': self.hits, 'disk_hits': self.disk_hits,
+              'misses': self.misses, 'evictions': self.evictions,
+              'disk_evictions': self.disk_evictions}
+
+  def _insert(self, key, prediction):
+    size = _nbytes(prediction)
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      if key in self._entries:
+        self.nbytes -= _nbytes(self._entries.pop(key))
+      self._entries[key] = prediction
+      self.nbytes += size
+      while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+        _, evicted = self._entries.popitem(last=False)
+        self.nbytes -= _nbytes(evicted)
+        self.evictions += 1
+
+  def _path(self, key):
+    return os.path.join(self.disk_dir, key + '.npz')
+
+  def _read_disk(self, key):
+    if not self.disk_dir:
+      return None
+    path = self._path(key)
+    try:
+      with np.load(path, allow_pickle=False) as data:
+        boxes, classes, scores = data['boxes'], data['classes'], data['scores']
+      os.utime(path, None)  # most recently used, see `_prune_disk`
+    except (IOError, OSError, KeyError, ValueError):
+      return None
+    if classes.dtype.kind == 'U':
+      classes = classes.astype(object)
+    prediction = (boxes, classes, scores)
+    for array in prediction:
+      array.flags.writeable = False
+    return prediction
+
+  def _write_disk(self, key, prediction):
+    if not self.disk_dir:
+      return
+    boxes, classes, scores = prediction
+    if classes.dtype == object:
+      classes = classes.astype(str)
+    # Write to a temporary file first so readers never see partial files
+    fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        np.savez(f, boxes=boxes, classes=classes, scores=scores)
+      os.rename(tmp_path, self._path(key))
+    except (IOError, OSError):
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      return
+
+    with self._lock:
+      self._disk_writes += 1
+      prune = self._disk_writes % self._prune_interval == 0
+    if prune:
+      self._prune_disk()
+
+  def _prune_disk(self):
+    """Remove the least recently used files once the disk tier exceeds
+    `max_disk_entries` or `max_disk_bytes`. Other processes may write and
+    prune the same directory concurrently."""
+    files = []
+    for name in os.listdir(self.disk_dir):
+      if not name.endswith('.npz'):
+        continue
+      try:
+        stat = os.stat(os.path.join(self.disk_dir, name))
+      except OSError:
+        continue  # removed by another process
+      files.append((stat.st_mtime, stat.st_size, name))
+
+    count, total = len(files), sum(size for _, size, _ in files)
+    if count <= self.max_disk_entries and total <= self.max_disk_bytes:
+      return
+    removed = 0
+    for _, size, name in sorted(files):
+      if (count <= _DISK_LOW_WATERMARK * self.max_disk_entries and
+          total <= _DISK_LOW_WATERMARK * self.max_disk_bytes):
+        break
+      try:
+        os.remove(os.path.join(self.disk_dir, name))
+        removed += 1
+      except OSError:
+        pass
+      count -= 1
+      total -= size
+    with self._lock:
+      self.disk_evictions += removed
+
+
+def _nbytes(prediction):
+  return sum(array.nbytes for array in prediction)
+
+
+def _copy(prediction):
+  return tuple(np.array(array) for array in prediction)
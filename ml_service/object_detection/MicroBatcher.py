@@ -0,0 +1,131 @@
+"""Client-side dynamic batching in front of ObjectDetection"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import time
+import threading
+import collections
+import numpy as np
+
+from concurrent import futures
+from six.moves import queue
+
+_STOP = object()
+
+
+class MicroBatcher(object):
+  """Collect single-image requests from many callers into batched RPCs.
+
+  Any number of threads (or coroutines, through `predict_async`) can call
+  this object as if it were `ObjectDetection.predict`. Requests are
+  collected for up to `max_batch_size` images or `max_wait_ms`, grouped by
+  image shape, and sent with `ObjectDetection.predict_batch_async`. Every
+  caller then receives its own boxes, classes and scores.
+
+  With an `encoded` detector, images are JPEG/PNG bytes decoded inside the
+  graph, where a batch must hold images of one size. They are batched by
+  the `image_size` given by the caller, and sent alone without it.
+  """
+
+  def __init__(self, detector, max_batch_size=8, max_wait_ms=5.0):
+    """
+    Args:
+      detector: an `ObjectDetection` client
+      max_batch_size: maximum number of images in one request
+      max_wait_ms: maximum time the first image of a batch waits for others
+    """
+    self.detector = detector
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000.0
+
+    self._queue = queue.Queue()
+    self._worker = threading.Thread(target=self._run, name='MicroBatcher')
+    self._worker.daemon = True
+    self._worker.start()
+
+  def predict(self, image, img_dtype=np.uint8, timeout=20.0, image_size=None):
+    """Blocking call, same contract as `ObjectDetection.predict`."""
+    return self.predict_async(image, img_dtype, timeout, image_size).result()
+
+  def predict_async(self, image, img_dtype=np.uint8, timeout=20.0, image_size=None):
+    """
+    Args:
+      image: a [height, width, 3] image, or encoded image bytes with an
+        `encoded` detector
+      img_dtype: data type of the image tensor
+      timeout: number of seconds to wait for the server
+      image_size: (height, width) of an encoded image once decoded. Only
+        encoded images of the same size share a request, the image is sent
+        alone if None. Ignored for raw images
+
+    Returns:
+      a `concurrent.futures.Future` resolving to (boxes, classes, scores)
+    """
+    result = futures.Future()
+    if self.detector.encoded:
+      group = None if image_size is None else tuple(image_size)
+    else:
+      image = np.asarray(image)
+      group = image.shape
+    self._queue.put((image, img_dtype, timeout, result, group))
+    return result
+
+  def close(self):
+    """Flush the queued requests and stop the batching thread."""
+    self._queue.put(_STOP)
+    self._worker.join()
+
+  def _run(self):
+    stopped = False
+    while not stopped:
+      first = self._queue.get()
+      if first is _STOP:
+        break
+      batch = [first]
+      deadline = time.time() + self.max_wait
+      while len(batch) < self.max_batch_size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        try:
+          item = self._queue.get(timeout=remaining)
+        except queue.Empty:
+          break
+        if item is _STOP:
+          stopped = True
+          break
+        batch.append(item)
+      self._send(batch)
+
+  def _send(self, batch):
+    # Only images of the same size (and dtype) can be stacked together,
+    # encoded images of unknown size are sent alone
+    groups = collections.OrderedDict()
+    for item in batch:
+      img_dtype, group = item[1], item[4]
+      groups.setdefault((group if group is not None else id(item), img_dtype), []).append(item)
+
+    for (_, img_dtype), items in groups.items():
+      callers = [item[3] for item in items]
+      try:
+        future = self.detector.predict_batch_async(
+            [item[0] for item in items],
+            img_dtype,
+            max(item[2] for item in items))
+      except Exception as e:  # pylint: disable=broad-except
+        for caller in callers:
+          caller.set_exception(e)
+        continue
+      future.add_done_callback(
+          lambda f, callers=callers: _scatter(f, callers))
+
+
+def _scatter(batch_future, callers):
+  """Hand every caller its own slice of a batched result."""
+  error = batch_future.exception()
+  if error is not None:
+    for caller in callers:
+      caller.set_exception(error)
+    return
+  for caller, prediction in zip(callers, batch_future.result()):
+    caller.set_result(prediction)
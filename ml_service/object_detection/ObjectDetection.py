@@ -4,13 +4,18 @@ from __future__ import print_function
 
 
 import time
+import threading
+import collections
 import numpy as np
-import tensorflow as tf
 
 # TensorFlow serving python API to send messages to server
-from grpc.beta import implementations
-from tensorflow_serving.apis import predict_pb2
-from tensorflow_serving.apis import prediction_service_pb2
+import grpc
+from concurrent import futures
+
+from ml_service.utils.parser import label_dict_to_array
+from ml_service.object_detection.ChannelPool import ChannelPool
+from ml_service.object_detection.PredictRequestBuilder import PredictRequestBuilder
+from ml_service.utils.tensor_utils import make_ndarray
 
 
 class ObjectDetection(object):
@@ -21,39 +26,316 @@ class ObjectDetection(object):
   * Interpret the result and send back to whoever calls it
   """
 
-  def __init__(self, host, port, model, label_dict, verbose=False):
+  def __init__(self, host, port, model, label_dict, verbose=False, max_in_flight=32,
+               resolve_labels=True, encoded=False, endpoints=None, version=None, cache=None):
+    """
+    Args:
+      host: host name of TF Serving server
+      port: port of TF Serving server
+      model: name of the served model
+      label_dict: a dictionary - key: obj_id value: obj-name
+      verbose: print number of detections and latency of every request
+      max_in_flight: maximum number of asynchronous requests sent to
+        the server at once. Extra requests are queued on the client
+      resolve_labels: if False, return raw int32 class ids instead of names
+      encoded: if True, images are passed as JPEG/PNG byte strings (e.g.
+        straight from the camera) and sent to the `predict_encoded_images`
+        signature, which decodes them inside the graph
+      endpoints: a list of 'host:port' TF Serving replicas. Overrides
+        `host` and `port`. Every request goes to the replica with the
+        fewest in-flight requests
+      version: version of the served model to use, latest if None
+      cache: an optional `DetectionCache`. Images already seen by this
+        model/version are answered from the cache without a request.
+        Requires an explicit `version`
+    """
+    if cache is not None and version is None:
+      raise ValueError('A DetectionCache requires an explicit model version: '
+                       'results of the latest version would outlive a new deployment')
     self.host = host
     self.port = port
     self.model = model
+    self.version = version
+    self.cache = cache
     self.label_dict = label_dict
+    self.label_array = label_dict_to_array(label_dict)
+    self.resolve_labels = resolve_labels
     self.verbose = verbose
+    self.max_in_flight = max_in_flight
+
+    if not endpoints:
+      endpoints = ['{}:{}'.format(self.host, int(self.port))]
+    self.pool = ChannelPool(endpoints)
+    self.encoded = encoded
+    if self.encoded:
+      self.request_builder = PredictRequestBuilder(self.model, 'predict_encoded_images', version=version,
+                                                   encoded=True)
+    else:
+      self.request_builder = PredictRequestBuilder(self.model, 'predict_images', version=version)
+
+    # Book-keeping for asynchronous requests
+    self._lock = threading.Lock()
+    self._in_flight = 0
+    self._pending = collections.deque()
+
+  def warmup(self, image=None, frame_size=(480, 640), num_requests=2, timeout=60.0):
+    """Prime every channel of the pool before serving real traffic.
+
+    Waits until each replica's channel is connected, then sends it a few
+    requests outside of the cache, so connection setup and the server's
+    lazy initialization are not paid by the first real frames.
+
+    Args:
+      image: a representative image (encoded bytes in `encoded` mode).
+        A black frame of `frame_size` is used if None
+      frame_size: (height, width) of the black frame
+      num_requests: number of requests sent to every replica
+      timeout: number of seconds to wait for each replica
+
+    Returns:
+      the list of endpoints that answered
+    """
+    if image is None:
+      if self.encoded:
+        raise ValueError('An encoded image is required to warm up in encoded mode')
+      image = np.zeros(tuple(frame_size) + (3,), dtype=np.uint8)
+    request, _ = self._make_batch_request([image], np.uint8)
+
+    ready = []
+    for replica in self.pool.replicas:
+      try:
+        grpc.channel_ready_future(replica.channel).result(timeout)
+        for _ in range(num_requests):
+          replica.stub.Predict(request, timeout)
+      except grpc.FutureTimeoutError:
+        print("Warmup of %s failed: not connected after %ss" % (replica.endpoint, timeout))
+        continue
+      except grpc.RpcError as e:
+        print("Warmup of %s failed: %s" % (replica.endpoint, e.code()))
+        continue
+      ready.append(replica.endpoint)
+    return ready
+
+  def predict(self, image, img_dtype=np.uint8, timeout=20.0):
+    """Detect objects in a single image.
 
-    channel = implementations.insecure_channel(self.host, int(self.port))
-    self.stub = prediction_service_pb2.beta_create_PredictionService_stub(channel)
+    Args:
+      image: a numpy array with shape [height, width, 3]
+        (encoded image bytes in `encoded` mode)
+      img_dtype: data type of the image tensor
+      timeout: number of seconds to wait for the server
 
-  def predict(self, image, img_dtype=tf.uint8, timeout=20.0):
+    Returns:
+      boxes: a float32 numpy array of shape [num_detections, 4]
+        (ymin, xmin, ymax, xmax) in normalized coordinates
+      classes: a numpy array of shape [num_detections] - class names,
+        or int32 class ids if `resolve_labels` is False
+      scores: a float32 numpy array of shape [num_detections]
+    """
+    return self.predict_batch([image], img_dtype, timeout)[0]
 
-    image = np.expand_dims(image, axis=0)
-    request = predict_pb2.PredictRequest()
-    request.inputs['inputs'].CopyFrom(tf.make_tensor_proto(
-        image,
-        dtype=img_dtype))
-    request.model_spec.name = self.model
-    request.model_spec.signature_name = 'predict_images'
+  def predict_batch(self, images, img_dtype=np.uint8, timeout=20.0):
+    """Detect objects in N same-sized images using a single request.
+
+    The exported `image_tensor` has a `None` batch dimension, so the whole
+    batch is sent in one round trip and the outputs are split back per image.
+
+    Args:
+      images: a list of N numpy arrays with shape [height, width, 3]
+        (or a numpy array with shape [N, height, width, 3]).
+        In `encoded` mode, a list of N encoded images of the same size
+      img_dtype: data type of the image tensor
+      timeout: number of seconds to wait for the server
+
+    Returns:
+      a list of N (boxes, classes, scores) tuples, one per image
+    """
+    if self.cache is None:
+      return self._send_batch(images, img_dtype, timeout)
+
+    predictions, keys, missing = self._lookup_cache(images)
+    if missing:
+      sent = self._send_batch([images[i] for i in missing], img_dtype, timeout)
+      self._store_cache(predictions, keys, missing, sent)
+    return predictions
+
+  def _send_batch(self, images, img_dtype, timeout):
+    request, batch_size = self._make_batch_request(images, img_dtype)
 
     start = time.time()
-    result = self.stub.Predict(request, timeout)  # 20 secs timeout
-    num_detections = int(result.outputs['num_detections'].float_val[0])
+    replica = self.pool.acquire()
+    try:
+      result = replica.stub.Predict(request, timeout)  # 20 secs timeout
+    except Exception as e:
+      self.pool.release(replica, e)
+      replica = self._failover(replica, e)
+      if replica is None:
+        raise
+      try:
+        result = replica.stub.Predict(request, _remaining(timeout, start))
+      except Exception as e:
+        self.pool.release(replica, e)
+        raise
+    self.pool.release(replica)
+    return self._parse_batch_result(result, batch_size, start)
+
+  def _failover(self, replica, error):
+    """Another healthy replica to retry a request that never reached
+    `replica` (UNAVAILABLE), None if the request must fail"""
+    if not (isinstance(error, grpc.RpcError) and error.code() == grpc.StatusCode.UNAVAILABLE):
+      return None
+    return self.pool.acquire(exclude=replica)
+
+  def predict_async(self, image, img_dtype=np.uint8, timeout=20.0):
+    """Non-blocking version of `predict`.
+
+    Returns:
+      a `concurrent.futures.Future` resolving to (boxes, classes, scores).
+      Use `asyncio.wrap_future` to await it from an event loop.
+    """
+    future = self.predict_batch_async([image], img_dtype, timeout)
+    result = futures.Future()
 
-    classes = result.outputs['detection_classes'].float_val[:num_detections]
-    scores = result.outputs['detection_scores'].float_val[:num_detections]
-    boxes = result.outputs['detection_boxes'].float_val[:num_detections * 4]
-    classes = [self.label_dict[int(idx)] if idx in self.label_dict.keys() else -1 for idx in classes ]
-    boxes = [boxes[i:i + 4] for i in range(0, len(boxes), 4)]
+    def _unwrap(batch_future):
+      if batch_future.exception() is not None:
+        result.set_exception(batch_future.exception())
+      else:
+        result.set_result(batch_future.result()[0])
+    future.add_done_callback(_unwrap)
+    return result
+
+  def predict_batch_async(self, images, img_dtype=np.uint8, timeout=20.0):
+    """Non-blocking version of `predict_batch`.
+
+    At most `max_in_flight` requests are outstanding on the channel, the
+    others wait in a client-side queue. This method never blocks the caller.
+
+    Returns:
+      a `concurrent.futures.Future` resolving to a list of N
+      (boxes, classes, scores) tuples
+    """
+    if self.cache is None:
+      return self._send_batch_async(images, img_dtype, timeout)
+
+    predictions, keys, missing = self._lookup_cache(images)
+    result = futures.Future()
+    if not missing:
+      result.set_result(predictions)
+      return result
+
+    def _merge(sent):
+      if sent.exception() is not None:
+        result.set_exception(sent.exception())
+      else:
+        self._store_cache(predictions, keys, missing, sent.result())
+        result.set_result(predictions)
+    self._send_batch_async([images[i] for i in missing], img_dtype, timeout).add_done_callback(_merge)
+    return result
+
+  def _send_batch_async(self, images, img_dtype, timeout):
+    request, batch_size = self._make_batch_request(images, img_dtype)
+    result = futures.Future()
+    with self._lock:
+      if self._in_flight >= self.max_in_flight:
+        self._pending.append((request, batch_size, timeout, result))
+        return result
+      self._in_flight += 1
+    self._dispatch(request, batch_size, timeout, result)
+    return result
+
+  def _dispatch(self, request, batch_size, timeout, result):
+    if not result.set_running_or_notify_cancel():
+      self._release()  # cancelled by the caller while queued
+      return
+    self._call(self.pool.acquire(), request, batch_size, timeout, result, time.time())
+
+  def _call(self, replica, request, batch_size, timeout, result, start, retry=True):
+    """Send a request to `replica`, and once to another replica if it
+    is unavailable"""
+    def _on_done(call):
+      error = call.exception()
+      self.pool.release(replica, error)
+      if error is not None and retry:
+        other = self._failover(replica, error)
+        if other is not None:
+          self._call(other, request, batch_size, _remaining(timeout, start), result, start, retry=False)
+          return
+      try:
+        if error is not None:
+          raise error
+        result.set_result(self._parse_batch_result(call.result(), batch_size, start))
+      except Exception as e:  # pylint: disable=broad-except
+        result.set_exception(e)
+      finally:
+        self._release()
+
+    try:
+      call = replica.stub.Predict.future(request, timeout)
+    except Exception as e:  # pylint: disable=broad-except
+      self.pool.release(replica, e)
+      result.set_exception(e)
+      self._release()
+      return
+    call.add_done_callback(_on_done)
+
+  def _release(self):
+    """Hand the freed slot to the next queued request, if any."""
+    with self._lock:
+      if not self._pending:
+        self._in_flight -= 1
+        return
+      next_request = self._pending.popleft()
+    self._dispatch(*next_request)
+
+  def _lookup_cache(self, images):
+    """
+    Returns:
+      predictions: a list of N cached predictions, None for cache misses
+      keys: the cache keys of the N images
+      missing: indices of the images that must be sent to the server
+    """
+    keys = [self.cache.key(image, self.model, self.version, self.resolve_labels) for image in images]
+    predictions = [self.cache.get(key) for key in keys]
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+    return predictions, keys, missing
+
+  def _store_cache(self, predictions, keys, missing, sent):
+    for i, prediction in zip(missing, sent):
+      self.cache.put(keys[i], prediction)
+      predictions[i] = prediction
+
+  def _make_batch_request(self, images, img_dtype):
+    # Accept TensorFlow dtypes (e.g. tf.uint8) as well as NumPy ones
+    img_dtype = getattr(img_dtype, 'as_numpy_dtype', img_dtype)
+    request = self.request_builder.build(images, img_dtype)
+    return request, len(images)
+
+  def _parse_batch_result(self, result, batch_size, start):
+    # Outputs are padded to `max_detections` per image:
+    # boxes [N, max_detections, 4], classes/scores [N, max_detections], num_detections [N]
+    all_num_detections = make_ndarray(result.outputs['num_detections']).reshape(batch_size).astype(np.int32)
+    all_classes = make_ndarray(result.outputs['detection_classes']).reshape(batch_size, -1).astype(np.int32)
+    all_scores = make_ndarray(result.outputs['detection_scores']).reshape(batch_size, -1)
+    all_boxes = make_ndarray(result.outputs['detection_boxes']).reshape(batch_size, -1, 4)
+
+    if self.resolve_labels:
+      last = len(self.label_array) - 1
+      all_classes = self.label_array[np.clip(all_classes, 0, last)]
+
+    predictions = []
+    for i in range(batch_size):
+      num_detections = all_num_detections[i]
+      predictions.append((all_boxes[i, :num_detections],
+                          all_classes[i, :num_detections],
+                          all_scores[i, :num_detections]))
 
     if self.verbose:
-        print("Number of detections: %s" % len(classes))
+        print("Number of detections: %s" % all_num_detections.sum())
         print("Server Prediction in {:.3f} ms".format(
             1000*(time.time() - start)))
-    return boxes, classes, scores
+    return predictions
+
 
+def _remaining(timeout, start):
+  """Time left of a request `timeout` started at `start`"""
+  return max(timeout - (time.time() - start), 0.0)
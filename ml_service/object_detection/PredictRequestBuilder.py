@@ -0,0 +1,55 @@
+"""Fast construction of PredictRequest messages"""
+from __future__ import absolute_import
+
+import numpy as np
+from ml_service.serving_apis import predict_pb2
+
+from ml_service.utils.tensor_utils import fill_tensor_proto
+from ml_service.utils.tensor_utils import fill_string_tensor
+
+
+class PredictRequestBuilder(object):
+  """Build PredictRequests from a prebuilt template.
+
+  The `model_spec` of a model/signature pair is only set up once. Every new
+  request is copied from the template and the image buffers are written
+  into `tensor_content` directly, skipping `tf.make_tensor_proto`.
+  """
+
+  def __init__(self, model, signature_name='predict_images', input_name='inputs', version=None,
+               encoded=False):
+    """
+    Args:
+      model: name of the served model
+      signature_name: name of the signature to run
+      input_name: name of the signature input holding the images
+      version: version of the model to use, latest if None
+      encoded: if True, images are JPEG/PNG byte strings sent as
+        a DT_STRING tensor instead of raw pixels
+    """
+    self.input_name = input_name
+    self.encoded = encoded
+    self.template = predict_pb2.PredictRequest()
+    self.template.model_spec.name = model
+    self.template.model_spec.signature_name = signature_name
+    if version is not None:
+      self.template.model_spec.version.value = int(version)
+
+  def build(self, images, dtype=np.uint8):
+    """
+    Args:
+      images: a list of N numpy arrays with shape [height, width, 3]
+        (or a numpy array with shape [N, height, width, 3]).
+        In encoded mode, a list of N encoded image byte strings
+      dtype: numpy data type of the image tensor (raw mode only)
+
+    Returns:
+      a PredictRequest ready to be sent
+    """
+    request = predict_pb2.PredictRequest()
+    request.CopyFrom(self.template)
+    if self.encoded:
+      fill_string_tensor(request.inputs[self.input_name], images)
+    else:
+      fill_tensor_proto(request.inputs[self.input_name], images, dtype)
+    return request
@@ -0,0 +1,116 @@
+"""Batched resizing of frames to the model input size"""
+from __future__ import absolute_import
+
+import cv2
+import numpy as np
+
+from concurrent import futures
+
+MODES = ('resize', 'letterbox')
+
+
+class Preprocessor(object):
+  """Resize or letterbox a batch of frames to the model input size.
+
+  Frames are resized in parallel on a thread pool: `cv2.resize` releases
+  the GIL, so the threads run on separate cores. Each frame's transform is
+  kept in a [N, 6] array of (scale_y, scale_x, top, left, height, width),
+  so detections of the whole batch are mapped back to the pixels of the
+  original frames in one vectorized step with `restore_boxes`.
+
+  Smaller input tensors cost less to serialize, send and run.
+  """
+
+  def __init__(self, target_size, mode='resize', num_threads=4,
+               interpolation=cv2.INTER_AREA, pad_value=0):
+    """
+    Args:
+      target_size: (width, height) of the model input, e.g. the
+        `frame_width`/`frame_height` of config.yml
+      mode: 'resize' stretches every frame to `target_size`, 'letterbox'
+        keeps the aspect ratio and pads the borders with `pad_value`
+      num_threads: number of resizing threads
+      interpolation: cv2 interpolation flag
+      pad_value: value of the letterbox borders
+    """
+    if mode not in MODES:
+      raise ValueError("Unknown mode '%s', choose from %s" % (mode, MODES))
+    self.width, self.height = target_size
+    self.mode = mode
+    self.interpolation = interpolation
+    self.pad_value = pad_value
+    self._executor = futures.ThreadPoolExecutor(max_workers=num_threads)
+
+  def process(self, frames):
+    """Resize `frames` into one batch.
+
+    Args:
+      frames: a list of uint8 [height, width, 3] images of any sizes
+
+    Returns:
+      batch: a uint8 array [N, target height, target width, 3]
+      transforms: a float32 array [N, 6], see `restore_boxes`
+    """
+    batch = np.empty((len(frames), self.height, self.width, 3), dtype=np.uint8)
+    transforms = np.empty((len(frames), 6), dtype=np.float32)
+    list(self._executor.map(self._process_one, range(len(frames)), frames,
+                            [batch] * len(frames), [transforms] * len(frames)))
+    return batch, transforms
+
+  def process_one(self, frame):
+    """Resize a single frame. Returns (image, transform)"""
+    batch, transforms = self.process([frame])
+    return batch[0], transforms[0]
+
+  def close(self):
+    self._executor.shutdown()
+
+  def _process_one(self, i, frame, batch, transforms):
+    height, width = frame.shape[:2]
+    if self.mode == 'resize':
+      scale_y, scale_x = self.height / float(height), self.width / float(width)
+      top = left = 0
+      if (height, width) == (self.height, self.width):
+        batch[i] = frame
+      else:
+        cv2.resize(frame, (self.width, self.height), dst=batch[i], interpolation=self.interpolation)
+    else:
+      scale_y = scale_x = min(self.height / float(height), self.width / float(width))
+      new_height = min(int(round(height * scale_y)), self.height)
+      new_width = min(int(round(width * scale_x)), self.width)
+      top, left = (self.height - new_height) // 2, (self.width - new_width) // 2
+      batch[i] = self.pad_value
+      batch[i, top:top + new_height, left:left + new_width] = cv2.resize(
+          frame, (new_width, new_height), interpolation=self.interpolation)
+    transforms[i] = (scale_y, scale_x, top, left, height, width)
+
+  def restore_boxes(self, boxes, transforms):
+    """Map normalized boxes of the model input back to original pixels.
+
+    Args:
+      boxes: a float array [N, K, 4], or a list of N arrays [K_i, 4], of
+        (ymin, xmin, ymax, xmax) normalized to the model input, as
+        returned by `ObjectDetection.predict_batch`
+      transforms: the [N, 6] array returned by `process`
+
+    Returns:
+      the boxes in pixels of the original frames, clipped to the frames,
+      in the same layout as `boxes`
+    """
+    transforms = np.asarray(transforms, dtype=np.float32).reshape(-1, 6)
+    if isinstance(boxes, (list, tuple)):
+      sizes = [len(frame_boxes) for frame_boxes in boxes]
+      flat = np.concatenate([np.reshape(frame_boxes, (-1, 4)) for frame_boxes in boxes] +
+                            [np.zeros((0, 4), np.float32)])
+      restored = self._restore(flat, np.repeat(transforms, sizes, axis=0))
+      return np.split(restored, np.cumsum(sizes)[:-1])
+    boxes = np.asarray(boxes, dtype=np.float32)
+    return self._restore(boxes, transforms[:, np.newaxis, :])
+
+  def _restore(self, boxes, transforms):
+    scale_y, scale_x, top, left, height, width = np.moveaxis(transforms, -1, 0)
+    input_size = np.array([self.height, self.width, self.height, self.width], dtype=np.float32)
+    offset = np.stack([top, left, top, left], axis=-1)
+    scale = np.stack([scale_y, scale_x, scale_y, scale_x], axis=-1)
+    upper = np.stack([height, width, height, width], axis=-1)
+    return np.clip((boxes * input_size - offset) / scale, 0, upper)
@@ -0,0 +1,126 @@
+"""Object detection on images larger than the model input, tile by tile"""
+from __future__ import absolute_import
+
+import numpy as np
+
+from ml_service.utils.box_utils import non_max_suppression
+
+# Default maximum size of a message received by a gRPC server
+GRPC_MAX_MESSAGE_BYTES = 4 << 20
+
+
+def tile_starts(length, tile, stride):
+  """Offsets of the tiles along one axis, the last tile ends on the edge"""
+  if length <= tile:
+    return [0]
+  starts = list(range(0, length - tile, stride))
+  return starts + [length - tile]
+
+
+class TiledDetection(object):
+  """Detect objects in very large images with overlapping tiles.
+
+  A 4K-12MP image sent whole either exceeds the gRPC message size or has
+  to be downscaled until small objects vanish. Here the image is cut into
+  overlapping tiles at native resolution. The tiles are sent in batches of
+  up to `batch_size` tiles and `max_request_bytes` through
+  `ObjectDetection.predict_batch_async`, so the requests stay bounded and
+  run in parallel, spread across the replicas when several endpoints are
+  configured. Tile boxes are mapped back to image pixels and duplicates
+  from the overlaps are merged with a vectorized per-class NMS.
+  """
+
+  def __init__(self, detector, tile_size=(1024, 1024), overlap=0.2, iou_threshold=0.5,
+               score_threshold=0.0, batch_size=4, max_request_bytes=GRPC_MAX_MESSAGE_BYTES,
+               max_detections=None):
+    """
+    Args:
+      detector: an `ObjectDetection` client
+      tile_size: (width, height) of the tiles, clipped to the image size
+      overlap: fraction of a tile shared with its neighbours, objects
+        smaller than the overlap are seen whole by at least one tile
+      iou_threshold: overlap above which the box with the lower score is
+        removed, e.g. `deploy_params.iou_threshold`
+      score_threshold: tile detections with a lower score are dropped before NMS
+      batch_size: maximum number of tiles per request
+      max_request_bytes: maximum size of the image tensor of a request,
+        a request holds at least one tile
+      max_detections: maximum number of detections per image, all if None
+    """
+    if not 0 <= overlap < 1:
+      raise ValueError('overlap must be in [0, 1), got %s' % overlap)
+    self.detector = detector
+    self.tile_width, self.tile_height = tile_size
+    self.overlap = overlap
+    self.iou_threshold = iou_threshold
+    self.score_threshold = score_threshold
+    self.batch_size = batch_size
+    self.max_request_bytes = max_request_bytes
+    self.max_detections = max_detections
+
+  def tiles(self, image_shape):
+    """Tile windows of an image.
+
+    Returns:
+      an int array [T, 4] of (top, left, bottom, right) in pixels
+    """
+    height, width = image_shape[:2]
+    tile_height, tile_width = min(self.tile_height, height), min(self.tile_width, width)
+    stride_y = max(int(tile_height * (1 - self.overlap)), 1)
+    stride_x = max(int(tile_width * (1 - self.overlap)), 1)
+    windows = [(top, left, top + tile_height, left + tile_width)
+               for top in tile_starts(height, tile_height, stride_y)
+               for left in tile_starts(width, tile_width, stride_x)]
+    return np.array(windows, dtype=np.int64)
+
+  def predict(self, image, img_dtype=np.uint8, timeout=20.0):
+    """Detect objects in an image of any size.
+
+    Args:
+      image: a [height, width, 3] image
+      img_dtype: data type of the image tensor
+      timeout: timeout in seconds of each request
+
+    Returns:
+      boxes: a float32 array [N, 4] of (ymin, xmin, ymax, xmax) in pixels
+        of `image` - not normalized like `ObjectDetection.predict`
+      classes: an array [N] of class names or ids
+      scores: a float32 array [N]
+    """
+    windows = self.tiles(image.shape)
+    tiles = [image[top:bottom, left:right] for top, left, bottom, right in windows]
+    tile_bytes = tiles[0].size * np.dtype(getattr(img_dtype, 'as_numpy_dtype', img_dtype)).itemsize
+    batch_size = max(min(self.batch_size, self.max_request_bytes // tile_bytes), 1)
+
+    # Send every batch first, so they are processed in parallel
+    requests = [self.detector.predict_batch_async(tiles[i:i + batch_size], img_dtype, timeout)
+                for i in range(0, len(tiles), batch_size)]
+    predictions = [prediction for request in requests for prediction in request.result()]
+    return self.merge(predictions, windows)
+
+  def merge(self, predictions, windows):
+    """Map the tile detections to image pixels and remove the duplicates.
+
+    Args:
+      predictions: a list of (boxes, classes, scores) per tile, with boxes
+        normalized to the tile
+      windows: the tile windows, see `tiles`
+
+    Returns:
+      (boxes, classes, scores) of the image, see `predict`
+    """
+    windows = np.asarray(windows, dtype=np.float32)
+    sizes = [len(scores) for _, _, scores in predictions]
+    boxes = np.concatenate([np.reshape(boxes, (-1, 4)) for boxes, _, _ in predictions]).astype(np.float32)
+    classes = np.concatenate([classes for _, classes, _ in predictions])
+    scores = np.concatenate([scores for _, _, scores in predictions]).astype(np.float32)
+
+    # Tile-normalized -> image pixels, all tiles at once
+    windows = np.repeat(windows, sizes, axis=0)
+    tile_height, tile_width = windows[:, 2] - windows[:, 0], windows[:, 3] - windows[:, 1]
+    boxes = boxes * np.stack([tile_height, tile_width] * 2, axis=1) + windows[:, [0, 1, 0, 1]]
+
+    kept = scores >= self.score_threshold
+    boxes, classes, scores = boxes[kept], classes[kept], scores[kept]
+    keep = non_max_suppression(boxes, scores, classes, self.iou_threshold, self.max_detections)
+    return boxes[keep], classes[keep], scores[keep]
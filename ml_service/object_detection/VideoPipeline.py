@@ -0,0 +1,236 @@
+"""Streaming video inference pipeline"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import time
+import threading
+import collections
+
+import cv2
+import numpy as np
+from six.moves import queue
+
+from ml_service.utils.painter import draw_boxes
+
+DROP_POLICIES = ('block', 'drop_oldest', 'latest')
+
+_STOP = object()
+
+
+class VideoPipeline(object):
+  """Run capture, inference, drawing and output as concurrent stages.
+
+  The stages are threads connected by bounded queues, so decoding the next
+  frame, waiting for the server and rendering the previous result overlap
+  instead of adding up. Up to `max_in_flight` frames are sent to the server
+  at once and results are emitted in capture order.
+
+  When inference falls behind the capture, `drop_policy` decides what
+  happens to the new frames:
+    * 'block': the capture waits (backpressure, no frame is lost)
+    * 'drop_oldest': the oldest queued frame is dropped
+    * 'latest': inference always skips to the most recent frame
+  """
+
+  def __init__(self, detector, source, output=None, frame_size=None, score_threshold=0.2,
+               max_in_flight=4, queue_size=8, drop_policy='block', timeout=20.0):
+    """
+    Args:
+      detector: any object with a `predict_async(image)` method returning a
+        future, e.g. `ObjectDetection` or `MicroBatcher`
+      source: a video file path or a camera device index for cv2.VideoCapture
+      output: path of the output video, or None to skip writing
+      frame_size: (width, height) frames are resized to before inference,
+        e.g. `inference.frame_width/frame_height` from config.yml
+      score_threshold: minimum score of the drawn detections
+      max_in_flight: number of frames sent to the server at once
+      queue_size: capacity of the queues between stages
+      drop_policy: one of 'block', 'drop_oldest' or 'latest'
+      timeout: number of seconds to wait for the server
+    """
+    if drop_policy not in DROP_POLICIES:
+      raise ValueError('drop_policy must be one of %s' % (DROP_POLICIES,))
+    self.detector = detector
+    self.source = source
+    self.output = output
+    self.frame_size = tuple(frame_size) if frame_size else None
+    self.score_threshold = score_threshold
+    self.max_in_flight = max_in_flight
+    self.drop_policy = drop_policy
+    self.timeout = timeout
+
+    self._frames = queue.Queue(maxsize=queue_size)
+    self._results = queue.Queue(maxsize=queue_size)
+    self._rendered = queue.Queue(maxsize=queue_size)
+    self._stop_event = threading.Event()
+    self._error = None
+
+    self.stats = collections.Counter()
+    self._stats_lock = threading.Lock()
+    self.fps = None
+
+  def run(self):
+    """Process the whole stream. Returns the pipeline statistics."""
+    capture = cv2.VideoCapture(self.source)
+    if not capture.isOpened():
+      raise IOError('Cannot open video source %s' % self.source)
+    self.fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+
+    stages = [threading.Thread(target=self._guard, args=(self._capture, capture), name='capture'),
+              threading.Thread(target=self._guard, args=(self._infer,), name='inference'),
+              threading.Thread(target=self._guard, args=(self._render,), name='render'),
+              threading.Thread(target=self._guard, args=(self._write,), name='output')]
+    start = time.time()
+    for stage in stages:
+      stage.daemon = True
+      stage.start()
+    try:
+      for stage in stages:
+        while stage.is_alive() and self._error is None:
+          stage.join(0.5)
+    except KeyboardInterrupt:
+      print("\nStopping the pipeline...")
+      self.stop()
+      for stage in stages:
+        stage.join()
+    if self._error is not None:
+      # The capture stage releases the capture once its last read returns
+      stages[0].join()
+      raise self._error
+
+    elapsed = time.time() - start
+    self.stats['seconds'] = elapsed
+    if elapsed > 0:
+      self.stats['output_fps'] = self.stats['written'] / elapsed
+    return self.stats
+
+  def stop(self):
+    """Ask the capture stage to stop. Queued frames are still processed."""
+    self._stop_event.set()
+
+  def _count(self, key):
+    # Several stages update the same counters, e.g. 'dropped'
+    with self._stats_lock:
+      self.stats[key] += 1
+
+  def _guard(self, stage, *args):
+    """Run a stage, stopping the pipeline if it fails."""
+    try:
+      stage(*args)
+    except Exception as e:  # pylint: disable=broad-except
+      self._error = e
+      self.stop()
+
+  def _capture(self, capture):
+    try:
+      while not self._stop_event.is_set():
+        ok, frame = capture.read()
+        if not ok:
+          break
+        if self.frame_size and frame.shape[1::-1] != self.frame_size:
+          frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+        self._count('captured')
+        self._put_frame(frame)
+    finally:
+      # Only this thread reads the capture, release it here and never
+      # during a read
+      capture.release()
+    self._put_unless_failed(self._frames, _STOP)
+
+  def _put_unless_failed(self, items, item, poll_interval=0.1):
+    """Blocking put, given up if a stage failed and no longer consumes `items`"""
+    while self._error is None:
+      try:
+        items.put(item, timeout=poll_interval)
+        return
+      except queue.Full:
+        pass
+
+  def _put_frame(self, frame):
+    if self.drop_policy == 'block':
+      self._put_unless_failed(self._frames, frame)
+      return
+    while True:
+      try:
+        self._frames.put_nowait(frame)
+        return
+      except queue.Full:
+        try:
+          self._frames.get_nowait()
+          self._count('dropped')
+        except queue.Empty:
+          pass
+
+  def _next_frame(self, block):
+    """Next frame to send, None if none is ready and `block` is False."""
+    try:
+      frame = self._frames.get(block=block)
+    except queue.Empty:
+      return None
+    if self.drop_policy == 'latest':
+      # Skip everything but the most recent frame
+      while frame is not _STOP:
+        try:
+          newer = self._frames.get_nowait()
+        except queue.Empty:
+          break
+        if newer is not _STOP:
+          self._count('dropped')
+        frame = newer
+    return frame
+
+  def _infer(self):
+    in_flight = collections.deque()
+    stopped = False
+    while not stopped or in_flight:
+      # Keep up to `max_in_flight` requests in the pipe
+      while not stopped and len(in_flight) < self.max_in_flight:
+        frame = self._next_frame(block=not in_flight)
+        if frame is None:
+          break
+        if frame is _STOP:
+          stopped = True
+          break
+        in_flight.append((frame, self.detector.predict_async(frame, timeout=self.timeout)))
+
+      if in_flight:
+        frame, future = in_flight.popleft()
+        try:
+          prediction = future.result()
+        except Exception as e:  # pylint: disable=broad-except
+          print("Inference failed: %s" % e)
+          self._count('failed')
+          continue
+        self._count('inferred')
+        self._results.put((frame, prediction))
+    self._results.put(_STOP)
+
+  def _render(self):
+    while True:
+      item = self._results.get()
+      if item is _STOP:
+        break
+      frame, (boxes, classes, scores) = item
+      keep = scores > self.score_threshold
+      if np.any(keep):
+        height, width = frame.shape[:2]
+        boxes = boxes[keep] * np.array([height, width, height, width])
+        frame = draw_boxes(frame, boxes, classes[keep], scores[keep])
+      self._rendered.put(frame)
+    self._rendered.put(_STOP)
+
+  def _write(self):
+    writer = None
+    while True:
+      frame = self._rendered.get()
+      if frame is _STOP:
+        break
+      if self.output:
+        if writer is None:
+          height, width = frame.shape[:2]
+          writer = cv2.VideoWriter(self.output, cv2.VideoWriter_fourcc(*'mp4v'),
+                                   self.fps, (width, height))
+        writer.write(frame)
+      self._count('written')
+    if writer is not None:
+      writer.release()
@@ -0,0 +1,59 @@
+"""TF Serving gRPC and protobuf modules, without importing TensorFlow
+
+The generated `tensorflow_serving.apis` modules import the `tensor_pb2`
+messages of `tensorflow.core.framework`. Importing them the usual way runs
+`tensorflow/__init__.py`, which takes seconds and hundreds of MB even
+though only the protobuf definitions are needed. Here, `tensorflow` is
+replaced by a bare package during these imports, so only the generated
+`_pb2` files are loaded. The `tensorflow` wheel must be installed, but
+clients depend on grpc, protobuf and NumPy only at run time.
+
+A later `import tensorflow` loads the real package and reuses the modules
+loaded here, so both can be used in the same process.
+
+Usage:
+  from ml_service.serving_apis import predict_pb2, prediction_service_pb2_grpc
+"""
+import sys
+import types
+import importlib
+
+try:
+  from importlib.util import find_spec
+except ImportError:  # Python 2
+  find_spec = None
+
+_MODULES = [
+    'tensorflow_serving.apis.predict_pb2',
+    'tensorflow_serving.apis.prediction_service_pb2_grpc',
+    'tensorflow_serving.apis.prediction_log_pb2',
+    'tensorflow_serving.apis.get_model_status_pb2',
+    'tensorflow_serving.apis.model_management_pb2',
+    'tensorflow_serving.apis.model_service_pb2_grpc',
+]
+
+
+def _import_without_tensorflow(names):
+  if 'tensorflow' in sys.modules or find_spec is None:
+    return [importlib.import_module(name) for name in names]
+
+  spec = find_spec('tensorflow')
+  package = types.ModuleType('tensorflow')
+  package.__path__ = list(spec.submodule_search_locations)
+  package.__spec__ = spec
+  sys.modules['tensorflow'] = package
+  try:
+    return [importlib.import_module(name) for name in names]
+  finally:
+    # The subpackages left in sys.modules (tensorflow.core, ...) have empty
+    # __init__ files, the real `tensorflow` is loaded on its first import
+    if sys.modules.get('tensorflow') is package:
+      del sys.modules['tensorflow']
+
+
+(predict_pb2,
+ prediction_service_pb2_grpc,
+ prediction_log_pb2,
+ get_model_status_pb2,
+ model_management_pb2,
+ model_service_pb2_grpc) = _import_without_tensorflow(_MODULES)
@@ -0,0 +1,64 @@
+"""Vectorized operations on [ymin, xmin, ymax, xmax] boxes
+"""
+import numpy as np
+
+
+def box_iou(boxes1, boxes2):
+  """IoU matrix of two arrays of [ymin, xmin, ymax, xmax] boxes
+
+  Args:
+    boxes1: a float array [N, 4]
+    boxes2: a float array [M, 4]
+
+  Returns:
+    a float array [N, M]
+  """
+  ymin = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+  xmin = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+  ymax = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+  xmax = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+  intersection = np.clip(ymax - ymin, 0, None) * np.clip(xmax - xmin, 0, None)
+  area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+  area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+  union = area1[:, None] + area2[None, :] - intersection
+  return intersection / np.maximum(union, 1e-8)
+
+
+def non_max_suppression(boxes, scores, classes=None, iou_threshold=0.5, max_detections=None):
+  """Greedy non-maximum suppression.
+
+  Each kept box suppresses, in one vectorized step, the lower-scored boxes
+  of its class overlapping it by more than `iou_threshold`. Memory stays
+  linear in the number of boxes.
+
+  Args:
+    boxes: a float array [N, 4]
+    scores: a float array [N]
+    classes: an array [N] of class ids or names, boxes of different
+      classes never suppress each other. Class-agnostic if None
+    iou_threshold: overlap above which the box with the lower score is removed
+    max_detections: maximum number of kept boxes, all if None
+
+  Returns:
+    an int array of the indices of the kept boxes, by decreasing score
+  """
+  order = np.argsort(-np.asarray(scores), kind='stable')
+  boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)[order]
+  class_ids = None
+  if classes is not None:
+    _, class_ids = np.unique(np.asarray(classes)[order], return_inverse=True)
+
+  active = np.ones(len(order), dtype=bool)
+  keep = []
+  for i in range(len(order)):
+    if not active[i]:
+      continue
+    keep.append(i)
+    if max_detections is not None and len(keep) >= max_detections:
+      break
+    rest = np.flatnonzero(active[i + 1:]) + i + 1
+    overlapping = box_iou(boxes[i:i + 1], boxes[rest])[0] > iou_threshold
+    if class_ids is not None:
+      overlapping &= class_ids[rest] == class_ids[i]
+    active[rest[overlapping]] = False
+  return order[np.array(keep, dtype=np.int64)]
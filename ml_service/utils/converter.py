@@ -1,8 +1,49 @@
 """Utilities to freeze model for interference
 """
+import os
+import sys
+import time
+import tempfile
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.util import compat
 from tensorflow.python.platform import gfile
+from tensorflow.tools.graph_transforms import TransformGraph
+from tensorflow_serving.apis import prediction_log_pb2
+
+from ml_service.object_detection.PredictRequestBuilder import PredictRequestBuilder
+from ml_service.utils.loadgen import summarize
+from ml_service.utils.box_utils import box_iou
+
+# Ops running the clusters compiled by the XLA JIT
+XLA_OPS = ('XlaLaunch', '_XlaCompile', '_XlaRun')
+
+# Graph Transform Tool presets, see
+# https://github.com/tensorflow/tensorflow/tree/master/tensorflow/tools/graph_transforms
+_OPTIMIZE_TRANSFORMS = [
+    'add_default_attributes',
+    'strip_unused_nodes(type=uint8, shape="-1,-1,-1,3")',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'merge_duplicate_nodes',
+    'sort_by_execution_order',
+]
+
+TRANSFORM_PRESETS = {
+    # Frozen graph as trained
+    'raw': ['add_default_attributes'],
+    # Smaller file, weights are converted back to float at load time
+    'default': ['add_default_attributes',
+                'quantize_weights', 'round_weights',
+                'fold_batch_norms', 'fold_old_batch_norms'],
+    # Fewer, merged nodes in execution order
+    'optimized': _OPTIMIZE_TRANSFORMS,
+    # Eight-bit ops where the CPU kernels exist
+    'quantized': _OPTIMIZE_TRANSFORMS[:-1] + ['quantize_weights', 'quantize_nodes',
+                                              'strip_unused_nodes', 'sort_by_execution_order'],
+}
+
 
 def load_graph_from_pb(model_filename):
   with tf.Session() as sess:
@@ -10,4 +51,297 @@ def load_graph_from_pb(model_filename):
       data = compat.as_bytes(f.read())
       graph_def = tf.GraphDef()
       graph_def.ParseFromString(data)
-  return graph_def
\ No newline at end of file
+  return graph_def
+
+
+def write_warmup_requests(export_path, model_name, image_sizes, batch_sizes=(1,),
+                          signature_name='predict_images'):
+  """Write `assets.extra/tf_serving_warmup_requests` into a SavedModel.
+
+  TF Serving replays these requests when it loads the model, so graph
+  initialization and memory allocation happen before the first real
+  request instead of showing up as latency spikes after every (re)start.
+
+  Args:
+    export_path: directory of the exported SavedModel version
+    model_name: name of the served model
+    image_sizes: a list of (height, width) of representative images
+    batch_sizes: a list of batch sizes to warm up
+    signature_name: signature taking raw uint8 images
+
+  Returns:
+    path of the warmup file
+  """
+  assets_dir = os.path.join(export_path, 'assets.extra')
+  if not os.path.isdir(assets_dir):
+    os.makedirs(assets_dir)
+  path = os.path.join(assets_dir, 'tf_serving_warmup_requests')
+
+  builder = PredictRequestBuilder(model_name, signature_name)
+  with tf.python_io.TFRecordWriter(path) as writer:
+    for height, width in image_sizes:
+      for batch_size in batch_sizes:
+        images = np.zeros((batch_size, height, width, 3), dtype=np.uint8)
+        log = prediction_log_pb2.PredictionLog(
+            predict_log=prediction_log_pb2.PredictLog(request=builder.build(images)))
+        writer.write(log.SerializeToString())
+  return path
+
+
+def load_sample_images(image_dir, frame_size=None, limit=None):
+  """Read the JPEG/PNG images of a directory as uint8 RGB arrays
+
+  Args:
+    image_dir: directory of sample images
+    frame_size: (width, height) the images are resized to, or None
+    limit: maximum number of images, all if None
+  """
+  import cv2
+  names = sorted(name for name in os.listdir(image_dir)
+                 if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+  images = []
+  for name in names[:limit]:
+    image = cv2.imread(os.path.join(image_dir, name))
+    if image is None:
+      continue
+    if frame_size is not None:
+      image = cv2.resize(image, tuple(frame_size))
+    images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+  if not images:
+    raise ValueError('No image found in %s' % image_dir)
+  return images
+
+
+def saved_model_size(export_path):
+  """Number of bytes of all the files of a SavedModel directory"""
+  size = 0
+  for root, _, files in os.walk(export_path):
+    size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+  return size
+
+
+def make_session_config(xla=False):
+  """A CPU-only `tf.ConfigProto`, with the XLA JIT compiling every
+  supported cluster of ops if `xla`.
+
+  On CPU devices, `global_jit_level` only clusters ops when the process
+  started with `TF_XLA_FLAGS=--tf_xla_cpu_global_jit`, see
+  `benchmark_saved_model_xla`.
+  """
+  config = tf.ConfigProto(device_count={'GPU': 0})
+  if xla:
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+  return config
+
+
+def benchmark_saved_model(export_path, images, signature_name='predict_images', runs=20,
+                          config=None, detections=None):
+  """Load a SavedModel in a local `tf.Session` and time CPU inference.
+
+  Args:
+    export_path: directory of the exported SavedModel version
+    images: a list of uint8 [height, width, 3] images, fed one at a time
+    signature_name: signature taking raw uint8 images
+    runs: number of timed inferences after the first one
+    config: a `tf.ConfigProto` of the session, see `make_session_config`
+    detections: a list, if given the (boxes, classes, scores) of every
+      image are appended to it, see `detection_agreement`
+
+  Returns:
+    a dictionary with the SavedModel size in MB, the load time and the
+    first inference time in ms (including the XLA compilation), the
+    number of XLA ops run by the first inference (`xla_ops`) and the
+    latencies of `loadgen.summarize`
+  """
+  if config is None:
+    config = make_session_config()
+  with tf.Graph().as_default():
+    with tf.Session(config=config) as sess:
+      start = time.time()
+      meta_graph = tf.saved_model.loader.load(
+          sess, [tf.saved_model.tag_constants.SERVING], export_path)
+      load_time = time.time() - start
+
+      signature = meta_graph.signature_def[signature_name]
+      input_name = signature.inputs['inputs'].name
+      output_names = [info.name for info in signature.outputs.values()]
+
+      run_metadata = tf.RunMetadata()
+      start = time.time()
+      sess.run(output_names, {input_name: images[0][np.newaxis]},
+               options=tf.RunOptions(output_partition_graphs=True), run_metadata=run_metadata)
+      first_run = time.time() - start
+      xla_ops = sum(node.op in XLA_OPS
+                    for graph in run_metadata.partition_graphs for node in graph.node)
+
+      latencies = []
+      start = time.time()
+      for i in range(runs):
+        tic = time.time()
+        sess.run(output_names, {input_name: images[i % len(images)][np.newaxis]})
+        latencies.append(time.time() - tic)
+      report = summarize(latencies, 0, time.time() - start)
+
+      if detections is not None:
+        names = [signature.outputs[key].name
+                 for key in ('detection_boxes', 'detection_classes', 'detection_scores', 'num_detections')]
+        for image in images:
+          boxes, classes, scores, num_detections = sess.run(names, {input_name: image[np.newaxis]})
+          num_detections = int(num_detections[0])
+          detections.append((boxes[0, :num_detections], classes[0, :num_detections].astype(np.int32),
+                             scores[0, :num_detections]))
+
+  report.update(size_mb=saved_model_size(export_path) / float(1 << 20),
+                load_ms=1000.0 * load_time,
+                first_run_ms=1000.0 * first_run,
+                xla_ops=xla_ops)
+  return report
+
+
+def _benchmark_xla_process(export_path, images, signature_name, runs, with_detections):
+  detections = [] if with_detections else None
+  report = benchmark_saved_model(export_path, images, signature_name, runs,
+                                 make_session_config(xla=True), detections)
+  return report, detections
+
+
+def benchmark_saved_model_xla(export_path, images, signature_name='predict_images', runs=20,
+                              detections=None):
+  """`benchmark_saved_model` with the XLA JIT, as TF Serving runs with `serving.xla`.
+
+  TensorFlow reads `TF_XLA_FLAGS` once, when it initializes: without
+  `--tf_xla_cpu_global_jit` nothing is compiled on CPU, whatever the
+  session config. The benchmark runs in a new Python process started
+  with the `XLA_JIT_FLAGS` of the server.
+
+  Raises:
+    RuntimeError: no op of the graph was compiled by XLA
+  """
+  import multiprocessing
+  from ml_service.TFServingServer import XLA_JIT_FLAGS
+
+  previous = os.environ.get('TF_XLA_FLAGS')
+  os.environ['TF_XLA_FLAGS'] = XLA_JIT_FLAGS
+  try:
+    pool = multiprocessing.get_context('spawn').Pool(1)
+  finally:
+    if previous is None:
+      del os.environ['TF_XLA_FLAGS']
+    else:
+      os.environ['TF_XLA_FLAGS'] = previous
+  try:
+    report, xla_detections = pool.apply(
+        _benchmark_xla_process, (export_path, images, signature_name, runs, detections is not None))
+  finally:
+    pool.close()
+    pool.join()
+
+  if not report['xla_ops']:
+    raise RuntimeError('No XLA cluster in %s with TF_XLA_FLAGS="%s", is TensorFlow built with XLA?'
+                       % (export_path, XLA_JIT_FLAGS))
+  if detections is not None:
+    detections.extend(xla_detections)
+  return report
+
+
+def format_variant_report(reports):
+  """A table of `benchmark_saved_model` results
+
+  Args:
+    reports: a list of (variant name, report), the report may have an
+      `agreement` with the float model
+  """
+  lines = ['{:<16} {:>9} {:>9} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+      'variant', 'size MB', 'load ms', 'first ms', 'p50 ms', 'p99 ms', 'img/s', 'agree')]
+  for name, report in reports:
+    agreement = report.get('agreement')
+    lines.append('{:<16} {size_mb:>9.1f} {load_ms:>9.0f} {first_run_ms:>10.0f} '
+                 '{p50:>9.1f} {p99:>9.1f} {throughput:>9.2f} '.format(name, **report) +
+                 ('{:>9.3f}'.format(agreement) if agreement is not None else '{:>9}'.format('-')))
+  return '\n'.join(lines)
+
+
+def detection_agreement(reference, candidate, iou_threshold=0.5, score_threshold=0.5):
+  """How much the detections of two models on the same images agree.
+
+  A candidate detection matches a reference detection of the same class
+  overlapping it by `iou_threshold` or more. Matches are greedy, by
+  decreasing reference score.
+
+  Args:
+    reference: a list of (boxes, classes, scores) per image, e.g. float model
+    candidate: a list of (boxes, classes, scores) per image, e.g. int8 model
+    iou_threshold: minimum overlap of matching detections
+    score_threshold: detections with a lower score are ignored
+
+  Returns:
+    the mean over the images of the F1 score of the matches, 1.0 when
+    both models detect the same objects
+  """
+  f1_scores = []
+  for (ref_boxes, ref_classes, ref_scores), (boxes, classes, scores) in zip(reference, candidate):
+    ref_kept = ref_scores >= score_threshold
+    kept = scores >= score_threshold
+    ref_boxes, ref_classes, ref_scores = ref_boxes[ref_kept], ref_classes[ref_kept], ref_scores[ref_kept]
+    boxes, classes = boxes[kept], classes[kept]
+    if not len(ref_boxes) and not len(boxes):
+      f1_scores.append(1.0)
+      continue
+
+    overlaps = box_iou(ref_boxes, boxes)
+    overlaps[ref_classes[:, None] != classes[None, :]] = 0.0
+    matches = 0
+    for i in np.argsort(-ref_scores):
+      if overlaps.shape[1] and overlaps[i].max() >= iou_threshold:
+        overlaps[:, overlaps[i].argmax()] = 0.0
+        matches += 1
+    f1_scores.append(2.0 * matches / (len(ref_boxes) + len(boxes)))
+  return float(np.mean(f1_scores))
+
+
+def calibrate_quantized_graph(graph_def, transforms, images, inputs, outputs, log_file=None):
+  """Quantize a frozen graph to eight bits with activation ranges measured
+  on sample images.
+
+  Without calibration, `quantize_nodes` computes the range of every
+  activation at run time to requantize it. Here the graph is first run on
+  `images` with the ranges logged, then the observed ranges are frozen in
+  the graph as constants.
+
+  Args:
+    graph_def: a frozen float graph
+    transforms: Graph Transform Tool transforms, including `quantize_nodes`
+    images: a list of uint8 [height, width, 3] calibration images
+    inputs: a list of input node names, the first one takes the images
+    outputs: a list of output node names
+    log_file: file collecting the logged ranges, a temporary file if None
+
+  Returns:
+    the calibrated eight-bit graph
+  """
+  quantized_graph = TransformGraph(graph_def, inputs, outputs, transforms)
+  logged_graph = TransformGraph(quantized_graph, inputs, outputs, [
+      'insert_logging(op=RequantizationRange, show_name=true, message="__requant_min_max:")'])
+
+  if log_file is None:
+    fd, log_file = tempfile.mkstemp(suffix='.log', prefix='requant_min_max_')
+    os.close(fd)
+
+  # The Print ops log to the stderr of the process
+  with tf.Graph().as_default():
+    tf.import_graph_def(logged_graph, name='')
+    with tf.Session(config=make_session_config()) as sess:
+      sys.stderr.flush()
+      stderr = os.dup(2)
+      log = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+      os.dup2(log, 2)
+      try:
+        for image in images:
+          sess.run([name + ':0' for name in outputs], {inputs[0] + ':0': image[np.newaxis]})
+      finally:
+        os.dup2(stderr, 2)
+        os.close(stderr)
+        os.close(log)
+
+  return TransformGraph(quantized_graph, inputs, outputs, [
+      'freeze_requantization_ranges(min_max_log_file="%s")' % log_file])
@@ -0,0 +1,6 @@
+"""Content hashes of image buffers and files
+"""
+import hashlib
+
+# blake2b is several times faster than sha1/md5 on large buffers
+new_hash = getattr(hashlib, 'blake2b', hashlib.sha1)
@@ -0,0 +1,100 @@
+"""Load generation and latency measurement for detection clients
+"""
+from __future__ import print_function
+
+import time
+import threading
+import numpy as np
+
+
+def run_load(predict, images, concurrency=1, rate=None, duration=10.0, warmup=1.0):
+  """Call `predict` from `concurrency` threads and measure latencies.
+
+  Without `rate`, every thread sends its next request as soon as the
+  previous one returns (closed loop). With `rate`, requests are scheduled
+  at a fixed rate and latency is measured from the scheduled time, so a
+  slow server is not hidden by the client waiting for it (open loop).
+
+  Args:
+    predict: a callable taking one element of `images`,
+      e.g. `ObjectDetection.predict`
+    images: a list of inputs to cycle through
+    concurrency: number of threads sending requests
+    rate: requests per second over all threads, or None
+    duration: number of seconds to measure
+    warmup: number of seconds of requests not included in the results
+
+  Returns:
+    a dictionary of results, see `summarize`
+  """
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+  counter = [0]
+  start = time.time()
+  measure_from = start + warmup
+  stop_at = measure_from + duration
+
+  def _worker():
+    while True:
+      with lock:
+        index = counter[0]
+        counter[0] += 1
+      if rate:
+        scheduled = start + index / float(rate)
+        delay = scheduled - time.time()
+        if delay > 0:
+          time.sleep(delay)
+      else:
+        scheduled = time.time()
+      if scheduled >= stop_at:
+        return
+
+      try:
+        predict(images[index % len(images)])
+        failed = False
+      except Exception:  # pylint: disable=broad-except
+        failed = True
+      done = time.time()
+
+      if scheduled >= measure_from:
+        with lock:
+          if failed:
+            errors[0] += 1
+          else:
+            latencies.append(done - scheduled)
+
+  threads = [threading.Thread(target=_worker) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = max(time.time(), stop_at) - measure_from
+  return summarize(latencies, errors[0], elapsed)
+
+
+def summarize(latencies, errors, elapsed):
+  """
+  Args:
+    latencies: a list of request latencies in seconds
+    errors: number of failed requests
+    elapsed: wall time in seconds of the measurement
+
+  Returns:
+    a dictionary with the number of requests and errors, the throughput
+    in requests per second and the p50/p95/p99/max latencies in ms
+  """
+  latencies_ms = 1000.0 * np.asarray(latencies, dtype=np.float64)
+  report = {'requests': len(latencies), 'errors': errors,
+            'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0}
+  if len(latencies_ms):
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    report.update(p50=p50, p95=p95, p99=p99, max=latencies_ms.max(), mean=latencies_ms.mean())
+  return report
+
+
+def format_report(report):
+  line = '{requests} requests, {errors} errors, {throughput:.1f} req/s'.format(**report)
+  if 'p50' in report:
+    line += ' | latency ms: p50 {p50:.1f}  p95 {p95:.1f}  p99 {p99:.1f}  max {max:.1f}'.format(**report)
+  return line
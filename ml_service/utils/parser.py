@@ -1,47 +1,217 @@
 import re
 import os
 import csv
+import json
+import tempfile
+import traceback
 import numpy as np
+from itertools import islice
+from six.moves import queue
 
+from ml_service.utils.hash_utils import new_hash
 
-def parse_label_map(label_map_path):
+
+# Tokens of a pbtxt file: braces, `key: value` pairs and bare keys
+_PBTXT_TOKEN = re.compile(r"""\{|\}|(\w+)\s*:?\s*("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[^\s{}"']+)?""")
+
+LABEL_MAP_CACHE_SUFFIX = '.cache.json'
+LABEL_MAP_CACHE_MODE = 0o644
+
+
+def iter_pbtxt_items(lines):
+  """Parse the `item { ... }` blocks of a label map, one line at a time
+
+  Fields can be in any order, on one or several lines, and string values
+  can be single or double quoted.
+
+  Args:
+    lines: an iterable of lines, e.g. an open .pbtxt file
+
+  Yields:
+    a dictionary per item, e.g. {'id': 1, 'name': '/m/01g317', 'display_name': 'Person'}
+  """
+  item = None
+  depth = 0
+  block = None
+  for line in lines:
+    if line.lstrip().startswith('#'):
+      continue
+    for match in _PBTXT_TOKEN.finditer(line):
+      token = match.group(0)
+      if token == '{':
+        depth += 1
+        if depth == 1 and block == 'item':
+          item = {}
+      elif token == '}':
+        depth -= 1
+        if depth == 0 and item is not None:
+          yield item
+          item = None
+      elif match.group(2) is None:
+        block = match.group(1)  # name of the next block
+      elif item is not None and depth == 1:
+        key, value = match.group(1), match.group(2)
+        if value[0] in '"\'':
+          item[key] = value[1:-1]
+        else:
+          item[key] = int(value) if value.lstrip('-').isdigit() else value
+
+
+def _compile_label_map(label_map_path):
+  with open(label_map_path, 'r') as f:
+    # Open image has {name: ... id: .... display_name: ...}
+    # MSCOCO and PASCAL have {id:... name: ...}
+    return {item['id']: item.get('display_name', item.get('name'))
+            for item in iter_pbtxt_items(f) if 'id' in item}
+
+
+def parse_label_map(label_map_path, use_cache=True):
   """Parse label map file into a dictionary
+
+  The result is cached in a JSON file next to the label map
+  (`LABEL_MAP_CACHE_SUFFIX`), so starting a worker does not parse the
+  .pbtxt again. The cache is used while the label map keeps its mtime and
+  size, or its content hash.
+
   Args:
-    label_map_path:
+    label_map_path: a .pbtxt label map
+    use_cache: read and write the compiled cache
 
   Returns:
     a dictionary : key: obj_id value: obj-name
   """
-  # Open image has different label maps:  {name: ... id: .... display_name: ...}
-  # MSCOCO and PASCAL has: {id:... name: ...}
-  is_oid = False
-  if 'oid' in label_map_path.split('/')[-1]:
-    is_oid = True
-    parser = re.compile(r'name:\s+\"(?P<name>[/\w_-]+)\"\s+id:\s+(?P<id>[0-9]+)\s+display_name:\s+\"(?P<display_name>[\w_-]+)\"')
+  if not use_cache:
+    return _compile_label_map(label_map_path)
+
+  cache_path = label_map_path + LABEL_MAP_CACHE_SUFFIX
+  stat = os.stat(label_map_path)
+  cache = None
+  if os.path.exists(cache_path):
+    try:
+      with open(cache_path, 'r') as f:
+        cache = json.load(f)
+    except (IOError, OSError, ValueError):
+      cache = None
+
+  if cache is not None and (cache['mtime'], cache['size']) == (stat.st_mtime, stat.st_size):
+    return {int(idx): name for idx, name in cache['labels'].items()}
+
+  with open(label_map_path, 'rb') as f:
+    digest = new_hash(f.read()).hexdigest()
+  if cache is not None and cache['hash'] == digest:
+    label_dict = {int(idx): name for idx, name in cache['labels'].items()}
   else:
-      parser = re.compile(r'id:[^\d]*(?P<id>[0-9]+)\s+name:[^\']*\'(?P<name>[\w_-]+)\'')
-  # Read label_map file
-  with open(label_map_path, 'r') as f:
-    lines = f.read().splitlines()
-    lines = ''.join(lines)
+    label_dict = _compile_label_map(label_map_path)
 
-    # match group having the same language 
-    result = parser.findall(lines)
-    if is_oid:
-      label_map_dict = {int(item[1]): item[2] for item in result}
-    else:
-      label_map_dict = {int(item[0]): item[1] for item in result}
+  # Best effort: the label map directory may be read-only
+  tmp_path = None
+  try:
+    # Named like the cache, so it is ignored by git if left by a crash
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)),
+                                    prefix='.tmp', suffix=os.path.basename(cache_path))
+    # Readable by workers running as other users, mkstemp creates it 0600
+    os.fchmod(fd, LABEL_MAP_CACHE_MODE)
+    with os.fdopen(fd, 'w') as f:
+      json.dump({'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': digest,
+                 'labels': {str(idx): name for idx, name in label_dict.items()}}, f)
+    os.rename(tmp_path, cache_path)
+  except (IOError, OSError, TypeError, ValueError):
+    if tmp_path is not None and os.path.exists(tmp_path):
+      os.remove(tmp_path)
+  return label_dict
+
+
+def load_label_array(label_map_path, unknown='N/A', use_cache=True):
+  """Dense id -> name array of a label map, see `label_dict_to_array`"""
+  return label_dict_to_array(parse_label_map(label_map_path, use_cache), unknown)
 
-    return label_map_dict
+
+def label_dict_to_array(label_dict, unknown='N/A'):
+  """Convert a label map dictionary into a dense id -> name array
+
+  The array has one extra trailing `unknown` entry, so any class id can be
+  resolved in one vectorized step with
+      `label_array[np.minimum(ids, len(label_array) - 1)]`
+
+  Args:
+    label_dict: a dictionary : key: obj_id value: obj-name
+    unknown: name used for ids that are not in the label map
+
+  Returns:
+    a numpy object array of shape [max_id + 2]
+  """
+  size = max(label_dict.keys()) + 2 if label_dict else 1
+  label_array = np.full(size, unknown, dtype=object)
+  for idx, name in label_dict.items():
+    label_array[idx] = name
+  return label_array
+
+
+def read_endpoints(endpoints):
+  """Resolve the `inference.endpoints` setting of config.yml
+
+  Args:
+    endpoints: None, a list of 'host:port' strings, or the path of a file
+      with one 'host:port' per line (e.g. published by `TFServingFleet`)
+
+  Returns:
+    a list of 'host:port' strings, or None
+  """
+  if not endpoints or not isinstance(endpoints, str):
+    return endpoints
+  with open(endpoints, 'r') as f:
+    return [line.strip() for line in f if line.strip()]
+
+
+def iter_annotations(filename, label_dict, skip_header=True):
+  """Stream the objects of an annotation file, one image at a time
+
+  Only the objects of the current image are held in memory, so the file
+  can be larger than RAM. The rows of an image must be contiguous, as in
+  files sorted by image.
+
+  Args:
+    filename: text file - has content format as
+        image_path, x1, y1, x2, y2, label1
+        image_path, x1, y1, x2, y2, label2
+    label_dict:  an encoding dictionary -
+      mapping class names to indices
+    skip_header: ignore the first line
+
+  Yields:
+    (image_path, boxes, labels) -
+      boxes: a float32 array [N, 4] of (y1, x1, y2, x2)
+      labels: an int32 array [N]
+  """
+  img_path = None
+  boxes = []
+  labels = []
+  with open(filename, "r") as f:
+    reader = csv.reader(f)
+    for line in islice(reader, 1 if skip_header else 0, None):
+      if not line:
+        continue  # Ignore empty line
+
+      if line[0] != img_path:
+        if boxes:
+          yield img_path, np.array(boxes, dtype=np.float32), np.array(labels, dtype=np.int32)
+        img_path, boxes, labels = line[0], [], []
+      x1, y1, x2, y2 = [float(x) for x in line[1:-1]]
+      boxes.append((y1, x1, y2, x2))
+      labels.append(label_dict[line[-1]])
+  if boxes:
+    yield img_path, np.array(boxes, dtype=np.float32), np.array(labels, dtype=np.int32)
 
 
 def parse_inputs(filename, label_dict):
   """Read input file and convert into inputs, labels for training
 
+  Everything is loaded in memory, use `iter_annotations` on large datasets.
+
   Args:
     filename: text file - has content format as
-        image_path, x1, x2, y1, y2, label1
-        image_path, x1, x2, y1, y2, label2
+        image_path, x1, y1, x2, y2, label1
+        image_path, x1, y1, x2, y2, label2
     label_dict:  an encoding dictionary -
       mapping class names to indices
 
@@ -50,25 +220,174 @@ def parse_inputs(filename, label_dict):
     labels :  a dictionary,
       key : image_path
       value: all objects in that image
-
-  @TODO: when dataset is large, we should consider this method a generator
   """
   training_instances = dict()
-  with open(filename, "r") as f:
-    reader = csv.reader(f)
-    for line in islice(reader, 1, None):
-      if not line:
-        continue  # Ignore empty line
+  for img_path, boxes, labels in iter_annotations(filename, label_dict):
+    objects = np.hstack([boxes, labels[:, np.newaxis].astype(np.float32)])
+    if img_path in training_instances:
+      training_instances[img_path] = np.vstack([training_instances[img_path], objects])
+    else:
+      training_instances[img_path] = objects
+  inputs = list(training_instances.keys())
+  labels = {k: v.flatten() for k, v in training_instances.items()}
+  return inputs, labels
 
-      img_path = line[0]
-      cls_name = line[-1]
-      x1, y1, x2, y2 = [float(x) for x in line[1:-1]]
-      an_object = [y1, x1, y2, x2, label_dict[cls_name]]
-
-      if img_path in training_instances:
-        training_instances[img_path].append(an_object)
-      else:
-        training_instances[img_path] = [an_object]
-  inputs = training_instances.keys()
-  labels = {k: np.stack(v).flatten() for k, v in training_instances.items()}
-  return inputs, labels
\ No newline at end of file
+
+def shard_path(output_prefix, shard, num_shards):
+  return '%s-%05d-of-%05d.tfrecord' % (output_prefix, shard, num_shards)
+
+
+def _make_example(img_path, boxes, labels, image_dir):
+  """A `tf.train.Example` with the fields of the Object Detection API
+
+  `boxes` are in pixels of the image, as in the annotation files. They are
+  normalized to [0, 1] by the image size, as the API expects.
+  """
+  import tensorflow as tf
+  from PIL import Image
+
+  path = os.path.join(image_dir, img_path) if image_dir else img_path
+  with open(path, 'rb') as f:
+    encoded = f.read()
+  image = Image.open(path)  # only reads the header
+  width, height = image.size
+  image_format = (image.format or os.path.splitext(path)[1][1:]).lower().encode('utf8')
+  boxes = np.clip(boxes / np.array([height, width, height, width], dtype=np.float32), 0.0, 1.0)
+
+  def _floats(values):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+  def _ints(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+  def _bytes(values):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
+  return tf.train.Example(features=tf.train.Features(feature={
+      'image/encoded': _bytes([encoded]),
+      'image/format': _bytes([image_format]),
+      'image/filename': _bytes([img_path.encode('utf8')]),
+      'image/height': _ints([height]),
+      'image/width': _ints([width]),
+      'image/object/bbox/ymin': _floats(boxes[:, 0]),
+      'image/object/bbox/xmin': _floats(boxes[:, 1]),
+      'image/object/bbox/ymax': _floats(boxes[:, 2]),
+      'image/object/bbox/xmax': _floats(boxes[:, 3]),
+      'image/object/class/label': _ints(labels),
+  }))
+
+
+def _write_shards(worker, tasks, errors, shards, output_prefix, num_shards, image_dir, counts):
+  """Worker process: write the images of its `shards` until it gets None.
+  Any other error is sent to the parent through `errors`."""
+  import tensorflow as tf
+  try:
+    writers = dict((shard, tf.python_io.TFRecordWriter(shard_path(output_prefix, shard, num_shards)))
+                   for shard in shards)
+    try:
+      while True:
+        item = tasks.get()
+        if item is None:
+          break
+        shard, img_path, boxes, labels = item
+        try:
+          example = _make_example(img_path, boxes, labels, image_dir)
+        except (IOError, OSError) as e:
+          print("Skipping %s: %s" % (img_path, e))
+          continue
+        writers[shard].write(example.SerializeToString())
+        counts[shard] += 1
+    finally:
+      for writer in writers.values():
+        writer.close()
+  except Exception:
+    errors.put((worker, traceback.format_exc()))
+    raise
+
+
+def _check_workers(workers, errors):
+  """Raise the error of a failed worker process, if any"""
+  if all(worker.exitcode in (None, 0) for worker in workers):
+    return
+  try:
+    worker, message = errors.get(timeout=1.0)
+  except queue.Empty:
+    # Killed without a traceback, e.g. by the OOM killer
+    worker = next(w for w, process in enumerate(workers) if process.exitcode not in (None, 0))
+    message = 'exit code %s' % workers[worker].exitcode
+  raise RuntimeError("TFRecord worker %d failed: %s" % (worker, message))
+
+
+def _put(tasks, item, workers, errors, poll_interval=1.0):
+  """Put `item` on a bounded queue, unless the workers have failed"""
+  while True:
+    try:
+      tasks.put(item, timeout=poll_interval)
+      return
+    except queue.Full:
+      _check_workers(workers, errors)
+
+
+def write_sharded_records(filename, label_dict, output_prefix, image_dir=None,
+                          num_shards=16, num_workers=None, queue_size=256):
+  """Convert an annotation file and its images into sharded TFRecord files
+
+  The annotations are streamed with `iter_annotations` and the images are
+  dealt round-robin to the shards. Each worker process reads, encodes and
+  writes the images of its own shards. The queues between the reader and
+  the workers are bounded, so memory does not grow with the dataset.
+
+  Boxes of the annotation file are in pixels, they are normalized by the
+  size of their image in the records.
+
+  Args:
+    filename: annotation file, see `iter_annotations`
+    label_dict:  an encoding dictionary -
+      mapping class names to indices
+    output_prefix: shards are written at `shard_path(output_prefix, i, num_shards)`
+    image_dir: directory the image paths are relative to, None if absolute
+    num_shards: number of TFRecord files
+    num_workers: number of worker processes, number of CPUs if None
+    queue_size: maximum number of images waiting for each worker
+
+  Returns:
+    a list of (shard path, number of images)
+
+  Raises:
+    RuntimeError: a worker process failed, the other workers are terminated
+  """
+  import multiprocessing
+
+  num_workers = min(num_workers or multiprocessing.cpu_count(), num_shards)
+  directory = os.path.dirname(output_prefix)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+
+  counts = multiprocessing.Array('l', num_shards)
+  errors = multiprocessing.Queue()
+  task_queues = [multiprocessing.Queue(queue_size) for _ in range(num_workers)]
+  workers = [multiprocessing.Process(
+      target=_write_shards,
+      args=(w, task_queues[w], errors, range(w, num_shards, num_workers),
+            output_prefix, num_shards, image_dir, counts))
+             for w in range(num_workers)]
+  for worker in workers:
+    worker.start()
+  try:
+    for index, (img_path, boxes, labels) in enumerate(iter_annotations(filename, label_dict)):
+      shard = index % num_shards
+      _put(task_queues[shard % num_workers], (shard, img_path, boxes, labels), workers, errors)
+    for tasks in task_queues:
+      _put(tasks, None, workers, errors)
+    for worker in workers:
+      while worker.is_alive():
+        worker.join(1.0)
+        _check_workers(workers, errors)
+    _check_workers(workers, errors)
+  except BaseException:
+    for worker in workers:
+      if worker.is_alive():
+        worker.terminate()
+      worker.join()
+    raise
+  return [(shard_path(output_prefix, shard, num_shards), counts[shard]) for shard in range(num_shards)]
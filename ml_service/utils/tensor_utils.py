@@ -0,0 +1,107 @@
+"""Utilities to convert TensorProto messages to/from NumPy arrays
+without going through TensorFlow
+"""
+import numpy as np
+
+# Values of tensorflow.DataType enum (tensorflow/core/framework/types.proto)
+DT_FLOAT = 1
+DT_DOUBLE = 2
+DT_INT32 = 3
+DT_UINT8 = 4
+DT_INT16 = 5
+DT_INT8 = 6
+DT_STRING = 7
+DT_INT64 = 9
+DT_BOOL = 10
+
+# DataType -> (numpy dtype, name of the repeated field holding the values)
+_DTYPES = {
+    DT_FLOAT: (np.float32, 'float_val'),
+    DT_DOUBLE: (np.float64, 'double_val'),
+    DT_INT32: (np.int32, 'int_val'),
+    DT_UINT8: (np.uint8, 'int_val'),
+    DT_INT16: (np.int16, 'int_val'),
+    DT_INT8: (np.int8, 'int_val'),
+    DT_INT64: (np.int64, 'int64_val'),
+    DT_BOOL: (np.bool_, 'bool_val'),
+}
+
+
+def make_ndarray(tensor):
+  """Convert a TensorProto into a NumPy array.
+
+  Reads `tensor_content` directly when the server packed the values into
+  it, otherwise converts the typed repeated field in a single step.
+
+  Args:
+    tensor: a TensorProto message
+
+  Returns:
+    a numpy array with the shape and dtype of the tensor
+  """
+  if tensor.dtype not in _DTYPES:
+    raise ValueError('Unsupported tensor dtype: %d' % tensor.dtype)
+  dtype, field = _DTYPES[tensor.dtype]
+  shape = [dim.size for dim in tensor.tensor_shape.dim]
+
+  if tensor.tensor_content:
+    array = np.frombuffer(tensor.tensor_content, dtype=dtype)
+  else:
+    array = np.array(getattr(tensor, field), dtype=dtype)
+
+  num_elements = int(np.prod(shape)) if shape else 1
+  if array.size == 1 and num_elements > 1:
+    # A single value means every element has that value
+    array = np.repeat(array, num_elements)
+  return array.reshape(shape)
+
+
+_NUMPY_TO_DTYPE = dict((np.dtype(dtype), dt) for dt, (dtype, _) in _DTYPES.items())
+
+
+def fill_tensor_proto(tensor, arrays, dtype=np.uint8):
+  """Write a batch of arrays into a TensorProto without TensorFlow.
+
+  The contiguous buffers are written into `tensor_content` and the shape is
+  set directly, so a list of images is stacked by a single copy instead of
+  `np.stack` + `tf.make_tensor_proto`.
+
+  Args:
+    tensor: a TensorProto message to fill (e.g. `request.inputs['inputs']`)
+    arrays: a numpy array with shape [N, ...] or a list of N same-shaped
+      numpy arrays
+    dtype: numpy data type of the tensor
+  """
+  dtype = np.dtype(dtype)
+  if isinstance(arrays, np.ndarray):
+    shape = arrays.shape
+    arrays = [arrays]
+  else:
+    shape = (len(arrays),) + arrays[0].shape
+    for array in arrays:
+      if array.shape != shape[1:]:
+        raise ValueError('All arrays must have the same shape, got %s and %s'
+                         % (shape[1:], array.shape))
+
+  buffers = [memoryview(np.ascontiguousarray(array, dtype=dtype)).cast('B')
+             for array in arrays]
+  tensor.dtype = _NUMPY_TO_DTYPE[dtype]
+  tensor.tensor_shape.Clear()
+  for size in shape:
+    tensor.tensor_shape.dim.add().size = size
+  tensor.tensor_content = buffers[0].tobytes() if len(buffers) == 1 else b''.join(buffers)
+
+
+def fill_string_tensor(tensor, values):
+  """Write a batch of byte strings (e.g. JPEG/PNG encoded images)
+  into a 1-D DT_STRING TensorProto.
+
+  Args:
+    tensor: a TensorProto message to fill
+    values: a list of N byte strings
+  """
+  tensor.dtype = DT_STRING
+  tensor.tensor_shape.Clear()
+  tensor.tensor_shape.dim.add().size = len(values)
+  del tensor.string_val[:]
+  tensor.string_val.extend(values)
@@ -31,7 +31,6 @@ import PIL.ImageColor as ImageColor
 import PIL.ImageDraw as ImageDraw
 import PIL.ImageFont as ImageFont
 import six
-import tensorflow as tf
 
 _TITLE_LEFT_MARGIN = 10
 _TITLE_TOP_MARGIN = 10
@@ -62,6 +61,27 @@ STANDARD_COLORS = [
 ]
 
 
+_FONT = []
+
+
+def _load_font():
+    """Font of the box labels, loaded once"""
+    if not _FONT:
+        try:
+            _FONT.append(ImageFont.truetype('arial.ttf', 24))
+        except IOError:
+            _FONT.append(ImageFont.load_default())
+    return _FONT[0]
+
+
+def _text_size(font, text):
+    """(width, height) of `text`, `getsize` was removed in Pillow 10"""
+    if hasattr(font, 'getbbox'):
+        left, top, right, bottom = font.getbbox(text)
+        return right, bottom
+    return font.getsize(text)
+
+
 def save_image_array_as_png(image, output_path):
     """Saves an image (represented as a numpy array) to PNG.
 
@@ -69,6 +89,7 @@ def save_image_array_as_png(image, output_path):
       image: a numpy array with shape [height, width, 3].
       output_path: path to which image should be written.
     """
+    import tensorflow as tf  # only for tf.gfile, slow to import
     image_pil = Image.fromarray(np.uint8(image)).convert('RGB')
     with tf.gfile.Open(output_path, 'w') as fid:
         image_pil.save(fid, 'PNG')
@@ -160,15 +181,12 @@ def draw_bounding_box_on_image(image,
         (left, right, top, bottom) = (xmin, xmax, ymin, ymax)
     draw.line([(left, top), (left, bottom), (right, bottom),
                (right, top), (left, top)], width=thickness, fill=color)
-    try:
-        font = ImageFont.truetype('arial.ttf', 24)
-    except IOError:
-        font = ImageFont.load_default()
+    font = _load_font()
 
     text_bottom = top
     # Reverse list and print from bottom to top.
     for display_str in display_str_list[::-1]:
-        text_width, text_height = font.getsize(display_str)
+        text_width, text_height = _text_size(font, display_str)
         margin = np.ceil(0.05 * text_height)
         draw.rectangle(
             [(left, text_bottom - text_height - 2 * margin), (left + text_width,
@@ -324,6 +342,68 @@ def draw_mask_on_image_array(image, mask, color='red', alpha=0.7):
     np.copyto(image, np.array(pil_image.convert('RGB')))
 
 
+def draw_masks_on_image_array(image, masks, colors, boxes=None, alpha=0.7):
+    """Draws several instance masks on an image in one pass.
+
+    Every mask is only blended inside its bounding region, in a float
+    buffer covering the union of the regions, which is written back to
+    `image` once. Masks are drawn in order, the last one on top, as with
+    successive calls of `draw_mask_on_image_array`.
+
+    Args:
+      image: uint8 numpy array with shape (img_height, img_width, 3)
+      masks: a float numpy array of shape (N, img_height, img_width), or a
+        list of N (img_height, img_width) arrays, with values between 0 and 1
+      colors: a list of N colors
+      boxes: a numpy array of shape [N, 4] of (ymin, xmin, ymax, xmax) in
+        pixels bounding the masks, computed from the masks if None
+      alpha: transparency value between 0 and 1. (default: 0.7)
+
+    Raises:
+      ValueError: On incorrect data type for image or masks.
+    """
+    if image.dtype != np.uint8:
+        raise ValueError('`image` not of type np.uint8')
+    if any(mask.dtype != np.float32 for mask in masks):
+        raise ValueError('`masks` not of type np.float32')
+    if not len(masks):
+        return
+    height, width = image.shape[:2]
+
+    regions = []
+    for i, mask in enumerate(masks):
+        if boxes is None:
+            rows = np.flatnonzero(mask.any(axis=1))
+            cols = np.flatnonzero(mask.any(axis=0))
+            if not len(rows):
+                continue
+            region = (rows[0], cols[0], rows[-1] + 1, cols[-1] + 1)
+        else:
+            ymin, xmin, ymax, xmax = boxes[i]
+            region = (max(int(np.floor(ymin)), 0), max(int(np.floor(xmin)), 0),
+                      min(int(np.ceil(ymax)) + 1, height), min(int(np.ceil(xmax)) + 1, width))
+        if region[2] > region[0] and region[3] > region[1]:
+            regions.append((i, region))
+    if not regions:
+        return
+
+    top = min(region[0] for _, region in regions)
+    left = min(region[1] for _, region in regions)
+    bottom = max(region[2] for _, region in regions)
+    right = max(region[3] for _, region in regions)
+    blended = image[top:bottom, left:right].astype(np.float32)
+
+    for i, (ymin, xmin, ymax, xmax) in regions:
+        mask = masks[i][ymin:ymax, xmin:xmax]
+        if np.any(np.logical_or(mask > 1.0, mask < 0.0)):
+            raise ValueError('`mask` elements should be in [0, 1]')
+        weight = (alpha * mask)[..., np.newaxis]
+        area = blended[ymin - top:ymax - top, xmin - left:xmax - left]
+        area += weight * (np.asarray(ImageColor.getrgb(colors[i]), np.float32) - area)
+
+    image[top:bottom, left:right] = np.round(blended).astype(np.uint8)
+
+
 def visualize_boxes_and_labels_on_image_array(image,
                                               boxes,
                                               classes,
@@ -335,7 +415,8 @@ def visualize_boxes_and_labels_on_image_array(image,
                                               max_boxes_to_draw=20,
                                               min_score_thresh=.5,
                                               agnostic_mode=False,
-                                              line_thickness=4):
+                                              line_thickness=4,
+                                              single_pass=True):
     """Overlay labeled boxes on an image with formatted scores and label names.
 
     This function groups boxes that correspond to the same location
@@ -365,6 +446,10 @@ def visualize_boxes_and_labels_on_image_array(image,
         class-agnostic mode or not.  This mode will display scores but ignore
         classes.
       line_thickness: integer (default: 4) controlling line width of the boxes.
+      single_pass: boolean (default: True) blend all the masks at once, then
+        convert the image to PIL once to draw all the boxes, labels and
+        keypoints. Otherwise every box, mask and keypoint set converts the
+        full image.
     """
     # Create a display string (and color) for every box location, group any boxes
     # that correspond to the same location.
@@ -401,6 +486,13 @@ def visualize_boxes_and_labels_on_image_array(image,
                     box_to_color_map[box] = STANDARD_COLORS[-1]  # Yellow Green
 
     # Draw all boxes onto image.
+    if single_pass:
+        _draw_single_pass(image, box_to_color_map, box_to_display_str_map,
+                          box_to_instance_masks_map if instance_masks is not None else None,
+                          box_to_keypoints_map if keypoints is not None else None,
+                          use_normalized_coordinates, line_thickness)
+        return
+
     for box, color in box_to_color_map.items():
         ymin, xmin, ymax, xmax = box
         if instance_masks is not None:
@@ -426,3 +518,43 @@ def visualize_boxes_and_labels_on_image_array(image,
                 color=color,
                 radius=int(line_thickness / 2),
                 use_normalized_coordinates=use_normalized_coordinates)
+
+
+def _draw_single_pass(image, box_to_color_map, box_to_display_str_map,
+                      box_to_instance_masks_map, box_to_keypoints_map,
+                      use_normalized_coordinates, line_thickness):
+    """Single-pass rendering of `visualize_boxes_and_labels_on_image_array`"""
+    boxes = list(box_to_color_map)
+    if not boxes:
+        return
+    colors = [box_to_color_map[box] for box in boxes]
+
+    if box_to_instance_masks_map is not None:
+        # Masks may extend past their detection box, each one is bounded
+        # by its own non-zero region so every mask pixel is drawn
+        draw_masks_on_image_array(
+            image,
+            [box_to_instance_masks_map[box] for box in boxes],
+            colors)
+
+    image_pil = Image.fromarray(np.uint8(image)).convert('RGB')
+    for box, color in zip(boxes, colors):
+        ymin, xmin, ymax, xmax = box
+        draw_bounding_box_on_image(
+            image_pil,
+            ymin,
+            xmin,
+            ymax,
+            xmax,
+            color=color,
+            thickness=line_thickness,
+            display_str_list=box_to_display_str_map[box],
+            use_normalized_coordinates=use_normalized_coordinates)
+        if box_to_keypoints_map is not None:
+            draw_keypoints_on_image(
+                image_pil,
+                box_to_keypoints_map[box],
+                color=color,
+                radius=int(line_thickness / 2),
+                use_normalized_coordinates=use_normalized_coordinates)
+    np.copyto(image, np.array(image_pil))
@@ -1,29 +1,53 @@
 """Object detection Server"""
+import argparse
+import os
 import yaml
 from ml_service.TFServingServer import TFServingServer
+from ml_service.TFServingFleet import TFServingFleet
+from ml_service.ServerSupervisor import ServerSupervisor
+from ml_service.BatchingAutotuner import BatchingAutotuner
+
+def autotune(config):
+  """Find the batching parameters with the best throughput within
+  the latency SLO and write them next to the generated config files"""
+  tuner = BatchingAutotuner.from_config(config)
+  config_dir = config.get('serving', {}).get('config_dir', './serving_config')
+  if not os.path.isdir(config_dir):
+    os.makedirs(config_dir)
+  output = os.path.join(config_dir, 'best.batching_parameters')
+  tuner.run()
+  best = tuner.write_best(output)
+  if best is None:
+    print("No configuration meets the latency SLO")
+  else:
+    print("Best batching parameters %s saved at %s" % (best, output))
 
 def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--autotune', action='store_true',
+                      help='sweep batching parameters instead of serving')
+  parser.add_argument('--fleet', action='store_true',
+                      help='serve with core-pinned replicas (serving.fleet in config.yml)')
+  args = parser.parse_args()
+
   # Parse Config
   with open('config.yml', 'r') as stream:
-    config = yaml.load(stream)
-  model_name = config['model_name']
-  model_path = config['model_path']
-
-  # Init Server
-  tfserving_server = TFServingServer(
-      port=9000, 
-      model_name=model_name, 
-      model_path=model_path)
-  tfserving_server.start()
-
-  # Wait for server to start
-  if tfserving_server.is_running():
-    try:
-      while tfserving_server.is_running():
-        continue
-    except KeyboardInterrupt as e:
-      print("\nWaiting for last predictions before turning off...")
-      tfserving_server.stop()
+    config = yaml.safe_load(stream)
+
+  if args.autotune:
+    autotune(config)
+    return
+
+  if args.fleet:
+    fleet = TFServingFleet.from_config(config)
+    config_dir = config.get('serving', {}).get('config_dir', './serving_config')
+    print("Endpoints published at %s" % fleet.publish_endpoints(os.path.join(config_dir, 'endpoints')))
+    ServerSupervisor(fleet.servers).run()
+    return
+
+  # Init Server, restart it if it crashes until SIGINT/SIGTERM
+  tfserving_server = TFServingServer.from_config(config)
+  ServerSupervisor(tfserving_server).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+"""Streaming object detection on a video file or camera"""
+from __future__ import print_function
+
+import argparse
+import yaml
+
+from ml_service.utils.parser import parse_label_map, read_endpoints
+from ml_service.object_detection.ObjectDetection import ObjectDetection
+from ml_service.object_detection.VideoPipeline import VideoPipeline, DROP_POLICIES
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('source', help='video file or camera device index')
+  parser.add_argument('--output', default='output.mp4', help='output video file')
+  parser.add_argument('--in-flight', type=int, default=4, help='requests sent to the server at once')
+  parser.add_argument('--queue-size', type=int, default=8, help='capacity of the queues between stages')
+  parser.add_argument('--drop-policy', choices=DROP_POLICIES, default='block',
+                      help='what to do with new frames when inference falls behind')
+  args = parser.parse_args()
+
+  # ############
+  # Parse Config
+  # ############
+  with open('config.yml', 'r') as stream:
+    config = yaml.safe_load(stream)
+  model_name = config['model_name']
+  inference = config['inference']
+  label_dict = parse_label_map(config['label_map'])
+
+  object_detector = ObjectDetection(
+      inference['host'],
+      inference['port'],
+      model_name,
+      label_dict,
+      max_in_flight=args.in_flight,
+      endpoints=read_endpoints(inference.get('endpoints')))
+
+  print('Warming up %s ...' % object_detector.warmup(
+      frame_size=(inference['frame_height'], inference['frame_width'])))
+
+  source = int(args.source) if args.source.isdigit() else args.source
+  pipeline = VideoPipeline(
+      object_detector,
+      source,
+      output=args.output,
+      frame_size=(inference['frame_width'], inference['frame_height']),
+      score_threshold=inference['score_threshold'],
+      max_in_flight=args.in_flight,
+      queue_size=args.queue_size,
+      drop_policy=args.drop_policy)
+
+  print('Streaming from %s ...' % args.source)
+  stats = pipeline.run()
+  print('Done! %s' % dict(stats))
+
+
+if __name__ == '__main__':
+  main()